@@ -0,0 +1,66 @@
+"""
+Validate the single-precision (PRECISION = SINGLE) model path against the double-precision reference.
+
+Reports run time, peak memory and the maximum deviations of the cross-sections, total optical depth and emergent
+spectra.
+
+Usage: python benchmarks/precision.py [config file]
+"""
+import sys
+import time
+import tracemalloc
+import numpy as np
+from scipy import sparse
+from h2ssscam.BaseCalc import BaseCalc
+from h2ssscam.Constants import Constants
+from h2ssscam.model import load_lines, run_model
+
+
+def measure(constant, lines):
+    """Run the model twice, untraced for the wall time in s and traced for the peak memory in MB."""
+    basecalc = BaseCalc(constant)
+    start = time.perf_counter()
+    result = run_model(constant, lines, basecalc)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    run_model(constant, lines)
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return result, basecalc, elapsed, peak
+
+
+def dense(values):
+    """Plain float64 array of a dense or sparse matrix or Quantity."""
+    values = values.toarray() if sparse.issparse(values) else getattr(values, "value", values)
+    return np.asarray(values, dtype=np.float64)
+
+
+def main():
+    config_file_path = sys.argv[1] if len(sys.argv) > 1 else None
+    constant = Constants(config_file_path)
+    lines = load_lines(constant)
+
+    runs = {}
+    for precision in ("DOUBLE", "SINGLE"):
+        constant.PRECISION = precision
+        runs[precision] = measure(constant, lines)
+
+    print(f"{'precision':>10} {'time (s)':>9} {'peak (MB)':>10} {'siglu dtype':>12}")
+    for precision, (_, basecalc, elapsed, peak) in runs.items():
+        print(f"{precision:>10} {elapsed:9.2f} {peak:10.0f} {str(basecalc._siglu.dtype):>12}")
+
+    (ref, ref_calc, _, _), (res, res_calc, _, _) = runs["DOUBLE"], runs["SINGLE"]
+    siglu_ref, siglu = dense(ref_calc._siglu), dense(res_calc._siglu)
+    peak_siglu = siglu_ref.max(axis=1, keepdims=True)
+    tau_ref, tau = dense(ref_calc._tau_tot), dense(res_calc._tau_tot)
+    print()
+    print(f"siglu     max |d|/line peak   {np.max(np.abs(siglu - siglu_ref) / peak_siglu):.2e}")
+    print(f"tau_tot   max |d|/tau         {np.max(np.abs(tau - tau_ref) / np.maximum(tau_ref, 1e-300)):.2e}")
+    for name in ("spec", "spec_tot"):
+        values_ref, values = ref[name].value, res[name].to_value(ref[name].unit)
+        deviation = np.max(np.abs(values - values_ref)) / np.max(np.abs(values_ref))
+        print(f"{name:<9} max |d|/max        {deviation:.2e}   flux ratio {values.sum() / values_ref.sum():.8f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Compare run time, peak memory and accuracy of the dense and sparse (SPARSE_THRESHOLD) model paths.
+
+Usage: python benchmarks/sparse_vs_dense.py [config file] [threshold ...]
+"""
+import sys
+import time
+import tracemalloc
+import numpy as np
+from h2ssscam.Constants import Constants
+from h2ssscam.model import load_lines, run_model
+
+
+def measure(constant, lines):
+    """Run the model twice, untraced for the wall time in s and traced for the peak memory in MB."""
+    start = time.perf_counter()
+    result = run_model(constant, lines)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    run_model(constant, lines)
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    config_file_path = sys.argv[1] if len(sys.argv) > 1 else None
+    thresholds = [float(t) for t in sys.argv[2:]] or [1e-4, 1e-6, 1e-8]
+
+    constant = Constants(config_file_path)
+    lines = load_lines(constant)
+    constant.SPARSE_THRESHOLD = 0
+    reference, elapsed, peak = measure(constant, lines)
+    spec_ref = reference["spec"].value
+    print(f"{'threshold':>10} {'time (s)':>9} {'peak (MB)':>10} {'max |dspec|/max spec':>21} {'flux ratio':>11}")
+    print(f"{'dense':>10} {elapsed:9.2f} {peak:10.0f} {0:21.2e} {1:11.6f}")
+
+    for threshold in thresholds:
+        constant.SPARSE_THRESHOLD = threshold
+        result, elapsed, peak = measure(constant, lines)
+        spec = result["spec"].value
+        error = np.max(np.abs(spec - spec_ref)) / np.max(spec_ref)
+        print(f"{threshold:10.0e} {elapsed:9.2f} {peak:10.0f} {error:21.2e} {spec.sum() / spec_ref.sum():11.6f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,95 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
+import contextlib
+import functools
+import hashlib
+import tempfile
+import threading
 from astropy.units import Quantity
-from scipy.special import wofz
+from scipy import sparse
+from scipy.special import erfcx, logsumexp, wofz
 import astropy.constants as c
 import astropy.units as u
 import numpy as np
 from h2ssscam.Constants import Constants
 
+# Line tiles handed out per worker in parallel mode, for load balancing
+TILES_PER_WORKER = 4
+
+# Lines per block when single-precision profiles are upcast for float64 accumulation
+LINE_CHUNK = 256
+
+# Temperature grid of the H2 population tables: log-spaced in K, with POPULATION_POINTS_PER_DEX points per decade
+POPULATION_TMIN = 10.0
+POPULATION_TMAX = 1e5
+POPULATION_POINTS_PER_DEX = 100
+
+# Number of temperatures whose H2 populations are kept in memory
+POPULATION_CACHE_SIZE = 256
+
+
+class CrossSectionCache:
+    """Least-recently-used store of absorption cross-sections, shared by the BaseCalc instances of successive models.
+
+    Models that evaluate the same lines at the same Doppler width (e.g. requests of a model server that differ only in
+    column densities) reuse the cross-sections instead of evaluating the Voigt profiles again. Safe to share between
+    threads; stored arrays are read-only.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Size limit of the stored cross-sections, by default 1 GB
+    """
+
+    def __init__(self, max_bytes=10**9):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(*args):
+        """Hash of the inputs of a cross-section evaluation: arrays, quantities, numbers, strings or None."""
+        digest = hashlib.sha256()
+        for arg in args:
+            if isinstance(arg, Quantity):
+                digest.update(arg.unit.to_string().encode())
+                arg = arg.value
+            digest.update(repr(np.shape(arg)).encode())
+            digest.update(np.ascontiguousarray(arg).tobytes() if isinstance(arg, np.ndarray) else repr(arg).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cross-sections stored under key, or None."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def put(self, key, siglu):
+        """Store cross-sections under key, evicting the least recently used beyond max_bytes, and return them."""
+        arrays = (siglu.data, siglu.indices, siglu.indptr) if sparse.issparse(siglu) else (siglu,)
+        for array in arrays:
+            array.flags.writeable = False
+        nbytes = sum(array.nbytes for array in arrays)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (siglu, nbytes)
+                self.nbytes += nbytes
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+        return siglu
+
 
 @dataclass
 class BaseCalc:
@@ -15,6 +99,13 @@ class BaseCalc:
     _tau: Quantity = None
     _tau_tot: Quantity = None
     _siglu: Quantity = None
+    siglu_cache: CrossSectionCache = None
+    _executor: ThreadPoolExecutor | ProcessPoolExecutor = None
+
+    @property
+    def dtype(self):
+        """Storage type of the line-by-wavelength matrices (cross-sections, optical depths and profiles)."""
+        return np.float32 if self.constant.PRECISION == "SINGLE" else np.float64
 
     @property
     def dv_phys(self):
@@ -32,7 +123,9 @@ class BaseCalc:
         if self._siglu is None:
             if lam is None or hih2_lamlu is None or hih2_Atot is None or hih2_flu is None:
                 raise ValueError("Here's should be an offensive message. To be implemented...")
-            self._siglu = self._calc_siglu(lam, hih2_lamlu, hih2_Atot, self.dv_phys, hih2_flu)
+            self._siglu = self._calc_siglu(
+                lam, hih2_lamlu, hih2_Atot, self.dv_phys, hih2_flu, threshold=self.constant.SPARSE_THRESHOLD
+            )
         return self._siglu
 
     def tau(self, hih2_N=None):
@@ -110,18 +203,16 @@ class BaseCalc:
 
         Notes
         -----
-        Implements Eq. 8 (McJunkin et al. 2016).
+        Implements Eq. 8 (McJunkin et al. 2016). The normalized populations come from level_populations: from the
+        population table with POPULATION_TABLE = ON, exactly otherwise.
         """
-
-        vs = np.arange(self.constant.VMAX + 1)
-        js = np.arange(self.constant.JMAX + 1)
-        es = self._calc_e(vs, js)
-        nvj = np.zeros((len(vs), len(js)))
-        for i in range(nvj.shape[0]):
-            for j in range(nvj.shape[1]):
-                nvj[i, j] = np.exp(-(es[i, j] / c.k_B / T).decompose())
-        nvj = ntot * nvj / np.sum(nvj, axis=None, keepdims=False)
-        return nvj
+        fractions = level_populations(
+            int(self.constant.VMAX),
+            int(self.constant.JMAX),
+            float(T.to_value(u.K)),
+            self.constant.POPULATION_TABLE == "ON",
+        )
+        return ntot * fractions
 
     def boltzmann(self, Ntot, ju, jl, lam, T):
         """Partitioning via Boltzmann distribution.
@@ -226,20 +317,43 @@ class BaseCalc:
         Returns
         -------
         array
-            Absorption rates per line.
+            Absorption rates per line; a scipy.sparse CSR array of values in unit if tau is sparse.
 
         Notes
         ------
         Implements Eq. 12-13 (McJunkin et al. 2016).
         """
 
+        if sparse.issparse(tau):
+            tau = tau.tocsr()
+            cols = tau.indices
+            tc = tau.data / np.asarray(tau_all)[cols] * tau.data
+            absr = I0.to_value(unit)[cols] * (1 - np.exp(-tc))
+            absr = np.nan_to_num(absr).astype(tau.dtype, copy=False)
+            return sparse.csr_array((absr, cols, tau.indptr), shape=tau.shape)
+
         absr = np.zeros_like(tau) * unit
         for i in range(tau.shape[0]):
             tc = tau[i] / tau_all * tau[i]
             absr[i] = I0 * (1 - np.exp(-tc))
         return np.nan_to_num(absr)
 
-    def calc_spec(self, lam, lamlu, Atot, dv, flux_per_trans, source, unit, dopp_v=0):
+    def calc_spec(
+        self,
+        lam,
+        lamlu,
+        Atot,
+        dv,
+        flux_per_trans,
+        source,
+        unit,
+        dopp_v=0 * u.km / u.s,
+        threshold=None,
+        tile_size=None,
+        out=None,
+        groups=None,
+        n_groups=None,
+    ):
         """Build emergent spectrum from line profiles + continuum.
 
         Parameters
@@ -253,13 +367,30 @@ class BaseCalc:
         dv : astropy.units.Quantity
             Doppler width.
         flux_per_trans : array
-            Flux per transition.
+            Flux per transition, shape (n_lines,) or (n_components, n_lines) to build one spectrum per row. More
+            leading axes, e.g. (n_components, n_groups, n_lines) for lines shared between groups, give one spectrum
+            per leading index.
         source : array
             Continuum source function.
         unit : astropy.units.Quantity
             Continuum units or CGS units.
         dopp_v : astropy.units.Quantity, optional
             Doppler Velocity.
+        threshold : float, optional
+            Truncate profiles below this fraction of their peak and store them sparsely, by default dense.
+        tile_size : int, optional
+            Build the spectrum in tiles of this many wavelength points, by default the whole grid at once. Peak
+            memory is then set by the tile size rather than by the grid length; with threshold set, only lines
+            whose profiles reach a tile are evaluated for it.
+        out : array, optional
+            Array (e.g. a numpy.memmap) that receives the emission spectrum in tiled mode, by default a memory-mapped
+            temporary file.
+        groups : array of int, optional
+            Group index of each line (e.g. from its band or upper vibrational level), by default no grouping. The
+            emission spectrum then has a group axis before the wavelength axis, one spectrum per group, built from
+            the same profile evaluation; summed over the group axis it is the ungrouped spectrum.
+        n_groups : int, optional
+            Length of the group axis, by default max(groups) + 1.
 
         Returns
         -------
@@ -267,26 +398,187 @@ class BaseCalc:
             Wavelength grid.
 
         array
-            Normalized emission-only spectrum.
+            Normalized emission-only spectrum, shape flux_per_trans.shape[:-1] (+ (n_groups,)) + (len(lam),).
 
         array
             Normalized total spectrum including continuum.
         """
 
-        profiles = np.zeros((len(lamlu), len(lam))) * unit
-        for i in range(len(lamlu)):
-            profiles[i, :] = (
-                flux_per_trans[i]
-                * self._voigt(lam, lamlu[i], Atot[i], dv)
-                / np.trapezoid(self._voigt(lam, lamlu[i], Atot[i], dv), lam).value
-            )
-
-        spec = np.sum(profiles, axis=0)
+        flux = np.asarray(flux_per_trans.to(unit).value)
+        shape = flux.shape[:-1]
+        if groups is not None:
+            n_groups = int(np.max(groups)) + 1 if n_groups is None else int(n_groups)
+            flux, shape = self._group_flux(flux, np.asarray(groups), n_groups), shape + (n_groups,)
+        elif flux.ndim > 2:
+            flux = sparse.csr_array(flux.reshape(-1, flux.shape[-1]))
+        with self._line_pool():
+            if tile_size:
+                out = out.reshape(flux.shape[:-1] + (len(lam),)) if out is not None else None
+                spec = self._calc_spec_tiled(lam, lamlu, Atot, dv, flux, threshold, int(tile_size), out)
+            else:
+                profiles = self.calc_profiles(lam, lamlu, Atot, dv, threshold)
+                spec = self._weighted_sum(profiles, flux)
+        spec = u.Quantity(spec.reshape(shape + (len(lam),)), unit, copy=False)
         spec_tot = spec + source
         lam_shifted = self._dopp_shift(lam, dopp_v)
 
         return lam_shifted, spec, spec_tot
 
+    def _calc_spec_tiled(self, lam, lamlu, Atot, dv, flux, threshold, tile_size, out=None):
+        """Accumulate flux-weighted profiles tile by tile along the wavelength axis.
+
+        Parameters
+        ----------
+        lam : astropy.units.Quantity
+            Wavelength grid.
+        lamlu : astropy.units.Quantity
+            Line wavelengths.
+        Atot : astropy.units.Quantity
+            Damping constants.
+        dv : astropy.units.Quantity
+            Doppler width.
+        flux : array or scipy.sparse array
+            Flux per transition, shape (n_lines,) or (n_spectra, n_lines).
+        threshold : float or None
+            Relative truncation threshold; lines are skipped for tiles outside their truncation window.
+        tile_size : int
+            Wavelength points per tile.
+        out : array, optional
+            Output array of shape flux.shape[:-1] + (len(lam),), by default a memory-mapped temporary file.
+
+        Returns
+        -------
+        array
+            The emission spectrum (out).
+
+        Notes
+        -----
+        Profiles are normalized by the analytic area of H(a,y), sqrt(pi) dv lam0 / c, instead of a trapezoid over
+        the full grid, which would need every line on every tile.
+        """
+        if out is None:
+            out = np.memmap(tempfile.TemporaryFile(), dtype=float, mode="w+", shape=flux.shape[:-1] + (len(lam),))
+        norm = (np.sqrt(np.pi) * dv / c.c * lamlu).to_value(lam.unit)
+        lam0 = lamlu.to_value(lam.unit)
+        if threshold:
+            half, h0 = self._voigt_halfwidth(lamlu, Atot, dv, threshold)
+            half, thresholds = half.to_value(lam.unit), threshold * h0
+        else:
+            half, thresholds = np.full(len(lamlu), np.inf), np.zeros(len(lamlu))
+
+        for start in range(0, len(lam), tile_size):
+            lam_tile = lam[start : start + tile_size]
+            reach = np.flatnonzero((lam0 + half >= lam_tile[0].value) & (lam0 - half <= lam_tile[-1].value))
+            tiles = self._map_lines(
+                self._tile_block, (lamlu[reach], Atot[reach], norm[reach], thresholds[reach]), lam_tile, dv
+            )
+            profiles = np.concatenate(tiles)
+            out[..., start : start + tile_size] = self._weighted_sum(profiles, flux[..., reach])
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
+
+    def _tile_block(self, lamlu, Atot, norm, thresholds, lam, dv):
+        """Normalized profiles of one tile of lines on one wavelength tile, zeroed below their thresholds."""
+        profiles = np.zeros((len(lamlu), len(lam)), dtype=self.dtype)
+        for i in range(len(lamlu)):
+            H_prof = np.asarray(self._voigt(lam, lamlu[i], Atot[i], dv))
+            profiles[i, :] = np.where(H_prof >= thresholds[i], H_prof / norm[i], 0)
+        return profiles
+
+    def _weighted_sum(self, profiles, flux):
+        """
+        Flux-weighted sum of profiles, (profiles.T @ flux.T).T, accumulated in float64 whatever the storage type of
+        dense profiles; single-precision profiles are upcast LINE_CHUNK lines at a time. A sparse flux matrix
+        (n_spectra, n_lines), e.g. of grouped lines, costs one pass over the profiles per stored flux value.
+        """
+        if sparse.issparse(flux):
+            flux = flux.tocsc()
+            if sparse.issparse(profiles) or profiles.dtype == np.float64:
+                spec = flux @ profiles
+                return spec.toarray() if sparse.issparse(spec) else spec
+            spec = np.zeros((flux.shape[0], profiles.shape[1]))
+            for start in range(0, len(profiles), LINE_CHUNK):
+                spec += flux[:, start : start + LINE_CHUNK] @ profiles[start : start + LINE_CHUNK].astype(np.float64)
+            return spec
+        if sparse.issparse(profiles) or profiles.dtype == np.float64:
+            return (profiles.T @ flux.T).T
+        spec = np.zeros(flux.shape[:-1] + (profiles.shape[1],))
+        for start in range(0, len(profiles), LINE_CHUNK):
+            block = profiles[start : start + LINE_CHUNK].astype(np.float64)
+            spec += (block.T @ flux[..., start : start + LINE_CHUNK].T).T
+        return spec
+
+    @staticmethod
+    def _group_flux(flux, groups, n_groups):
+        """Sparse flux matrix (n_spectra * n_groups, n_lines) with the flux of every line in the row of its group."""
+        flux = flux.reshape(-1, flux.shape[-1])
+        rows = np.arange(len(flux))[:, None] * n_groups + groups
+        cols = np.broadcast_to(np.arange(flux.shape[1]), rows.shape)
+        shape = (len(flux) * n_groups, flux.shape[1])
+        return sparse.csr_array((flux.ravel(), (rows.ravel(), cols.ravel())), shape=shape)
+
+    def calc_profiles(self, lam, lamlu, Atot, dv, threshold=None):
+        """Compute area-normalized emission line profiles on a wavelength grid.
+
+        Parameters
+        ----------
+        lam : astropy.units.Quantity
+            Wavelength grid.
+        lamlu : astropy.units.Quantity
+            Line wavelengths.
+        Atot : astropy.units.Quantity
+            Damping constants.
+        dv : astropy.units.Quantity
+            Doppler width.
+        threshold : float, optional
+            Truncate profiles below this fraction of their peak and store them sparsely, by default dense.
+
+        Returns
+        -------
+        array
+            Profiles of shape (n_lines, n_lam), each integrating to one over lam (in Å); a scipy.sparse CSR array
+            when threshold is set.
+        """
+        if threshold:
+            threshold, scale = np.full(len(lamlu), float(threshold)), np.ones(len(lamlu))
+            tiles = self._map_lines(self._voigt_rows, (lamlu, Atot, threshold, scale), lam, dv, True)
+            return self._to_csr([row for rows in tiles for row in rows], len(lam))
+
+        return np.concatenate(self._map_lines(self._profile_block, (lamlu, Atot), lam, dv))
+
+    def _profile_block(self, lamlu, Atot, lam, dv):
+        """Dense area-normalized profiles for one tile of lines, see calc_profiles."""
+        profiles = np.zeros((len(lamlu), len(lam)), dtype=self.dtype)
+        for i in range(len(lamlu)):
+            H_prof = self._voigt(lam, lamlu[i], Atot[i], dv)
+            profiles[i, :] = H_prof / np.trapezoid(H_prof, lam).value
+        return profiles
+
+    def calc_dlam(self, dv, lam, samples_per_fwhm):
+        """Wavelength spacing that samples a Doppler profile with a given number of points per FWHM.
+
+        Parameters
+        ----------
+        dv : astropy.units.Quantity
+            Doppler width.
+        lam : astropy.units.Quantity
+            Wavelength at which the profile is sampled; the FWHM in wavelength grows with lam.
+        samples_per_fwhm : float
+            Number of samples per FWHM.
+
+        Returns
+        -------
+        astropy.units.Quantity
+            Wavelength spacing in Å.
+
+        Notes
+        -----
+        The Doppler core of H(a,y) is exp(-(Δv/dv)^2), with FWHM = 2 sqrt(ln 2) dv.
+        """
+        fwhm = 2 * np.sqrt(np.log(2)) * dv / c.c * lam
+        return (fwhm / samples_per_fwhm).to(u.AA)
+
     def _dopp_shift(self, lam, dopp_v):
         """Apply non-relativistic Doppler wavelength shift.
 
@@ -304,7 +596,98 @@ class BaseCalc:
 
         return lam * (1 + dopp_v / c.c)
 
-    def _calc_e(self, v, j):
+    def _dopp_resample(self, lam, values, dopp_v):
+        """Resample values given on lam in an emitter's frame onto lam in a frame where the emitter moves at dopp_v.
+
+        Parameters
+        ----------
+        lam : astropy.units.Quantity
+            Monotonically increasing wavelength grid.
+        values : array or astropy.units.Quantity
+            Values on lam with wavelength along the last axis; any leading axes are resampled together. A 2-D
+            scipy.sparse array is resampled with a sparse interpolation matrix.
+        dopp_v : astropy.units.Quantity
+            Doppler shift velocity of the emitter.
+
+        Returns
+        -------
+        array or astropy.units.Quantity
+            Linearly interpolated values, zero outside the original grid.
+        """
+        if dopp_v == 0:
+            return values
+        lam_rest = (lam / (1 + dopp_v / c.c)).to(lam.unit).value
+        x = lam.value
+        idx = np.clip(np.searchsorted(x, lam_rest) - 1, 0, len(x) - 2)
+        w = ((lam_rest - x[idx]) / (x[idx + 1] - x[idx])).astype(values.dtype, copy=False)
+        outside = (lam_rest < x[0]) | (lam_rest > x[-1])
+        if sparse.issparse(values):
+            cols = np.flatnonzero(~outside)
+            rows = np.concatenate([idx[cols], idx[cols] + 1])
+            weights = np.concatenate([1 - w[cols], w[cols]])
+            interp = sparse.csr_array((weights, (rows, np.tile(cols, 2))), shape=(len(x), len(x)))
+            return (values @ interp).tocsr()
+        out = values[..., idx] * (1 - w) + values[..., idx + 1] * w
+        out[..., outside] = 0
+        return out
+
+    def resample_spectra(self, lam, spectra, dopp_v, lam_out):
+        """Doppler-shift a batch of spectra by per-spectrum velocities and rebin them onto one output grid.
+
+        Spectrum i is taken on its shifted grid lam * (1 + dopp_v[i] / c), as returned by calc_spec and run_model,
+        and is integrated exactly over the cells of lam_out, so the flux of every spectrum over any range of whole
+        output cells is conserved, also on coarser output grids.
+
+        Parameters
+        ----------
+        lam : astropy.units.Quantity
+            Monotonically increasing rest-frame wavelength grid shared by the spectra.
+        spectra : array or astropy.units.Quantity
+            Spectra per unit wavelength, shape (n_spectra, ..., len(lam)), or (1, ..., len(lam)) for one spectrum
+            shifted by every velocity; any middle axes are resampled together.
+        dopp_v : astropy.units.Quantity
+            Doppler shift velocity, one per spectrum (or a scalar).
+        lam_out : astropy.units.Quantity
+            Monotonically increasing output wavelength grid.
+
+        Returns
+        -------
+        array or astropy.units.Quantity
+            Mean of each shifted spectrum over the output cells, shape (n, ..., len(lam_out)) with n the number of
+            spectra or velocities; zero where the shifted grid does not reach.
+
+        Notes
+        -----
+        Each grid point stands for the cell between the midpoints to its neighbours, within which the spectrum is
+        taken as constant. All spectra are rebinned through one cumulative-integral table and one vectorized lookup.
+        """
+        unit = getattr(spectra, "unit", None)
+        values = np.asarray(getattr(spectra, "value", spectra), dtype=np.float64)
+        factor = np.atleast_1d(1 + (dopp_v / c.c).decompose().value)
+        n = max(len(values), len(factor))
+        middle = values.shape[1:-1]
+        values = values.reshape(len(values), -1, values.shape[-1])
+
+        # cumulative integral at the rest-frame cell edges; shifted, it is factor times this at edges * factor
+        edges = _cell_edges(lam.value)
+        cumulative = np.zeros(values.shape[:-1] + (len(edges),))
+        np.cumsum(values * np.diff(edges), axis=-1, out=cumulative[..., 1:])
+
+        # output cell edges in each spectrum's rest frame, clipped to the covered range
+        edges_out = _cell_edges(lam_out.to_value(lam.unit))
+        query = np.clip(edges_out / np.broadcast_to(factor, (n,))[:, None], edges[0], edges[-1])
+        idx = np.clip(np.searchsorted(edges, query) - 1, 0, len(edges) - 2)
+        w = ((query - edges[idx]) / (edges[idx + 1] - edges[idx]))[:, None, :]
+        rows = (np.arange(n) if len(values) > 1 else np.zeros(n, dtype=int))[:, None, None]
+        cols = np.arange(values.shape[1])[None, :, None]
+        at_edges = cumulative[rows, cols, idx[:, None, :]] * (1 - w) + cumulative[rows, cols, idx[:, None, :] + 1] * w
+        at_edges *= np.broadcast_to(factor, (n,))[:, None, None]
+
+        out = (np.diff(at_edges, axis=-1) / np.diff(edges_out)).reshape((n,) + middle + (len(lam_out),))
+        return out if unit is None else out * unit
+
+    @staticmethod
+    def _calc_e(v, j):
         """
         Compute ro-vibrational energy E(v,J).
 
@@ -373,13 +756,17 @@ class BaseCalc:
         Returns
         -------
         astropy.units.Quantity
-            Optical depth as a function of wavelength and transition.
+            Optical depth as a function of wavelength and transition; a scipy.sparse CSR array if siglu is sparse
+            (siglu then holds values in cm^2).
 
         Notes
         -----
         Implements Eq. 11 (McJunkin et al. 2016).
         """
-        return (nvj[:, None] * siglu).decompose()
+        nvj = nvj.to_value(u.cm**-2).astype(siglu.dtype)
+        if sparse.issparse(siglu):
+            return sparse.csr_array(siglu.multiply(nvj[:, None]))
+        return u.Quantity(np.multiply(nvj[:, None], siglu.to_value(u.cm**2)), copy=False)
 
     def _calc_tau_tot(self):
         """
@@ -390,7 +777,10 @@ class BaseCalc:
         array
             Optical depth as a function of wavelength.
         """
-        self._tau_tot = self._tau.sum(axis=0)  # total tau(lambda)
+        if sparse.issparse(self._tau):
+            self._tau_tot = np.asarray(self._tau.sum(axis=0, dtype=np.float64)) * u.dimensionless_unscaled
+            return self._tau_tot
+        self._tau_tot = self._tau.sum(axis=0, dtype=np.float64)  # total tau(lambda)
         return self._tau_tot
 
     def _voigt(self, lam, lam0, gam, dv):
@@ -424,9 +814,9 @@ class BaseCalc:
         y = np.abs(nu - nu0) / dnu
         return np.real(wofz(y + 1j * a))
 
-    def _calc_siglu(self, lam, lamlu, Atot, dv, flu):
+    def _calc_siglu(self, lam, lamlu, Atot, dv, flu, threshold=None, nvj=None):
         """
-        Compute absorption cross-section sigma_lu(lambda).
+        Compute absorption cross-section sigma_lu(lambda), or take it from siglu_cache if one is set.
 
         Parameters
         ----------
@@ -440,45 +830,386 @@ class BaseCalc:
             Doppler width.
         flu : array
             Oscillator strengths f_lu.
+        threshold : float, optional
+            Truncate cross-sections below this fraction of their peak and store them sparsely, by default dense.
+        nvj : astropy.units.Quantity, optional
+            Column densities of the lower levels. If given, a line is truncated where its optical depth falls below
+            threshold times min(1, peak optical depth), which keeps the damping wings of saturated lines.
 
         Returns
         -------
         astropy.units.Quantity
-            sigma_lu(lambda) array in cm^2.
+            sigma_lu(lambda) array in cm^2; a scipy.sparse CSR array of values in cm^2 when threshold is set.
 
         Notes
         -----
         Implements Eq. 4 (McJunkin et al. 2016).
         """
-        siglu = np.zeros((len(lamlu), len(lam))) * u.cm**2
+        if self.siglu_cache is None:
+            return self._eval_siglu(lam, lamlu, Atot, dv, flu, threshold, nvj)
+        # nvj only matters for truncated cross-sections
+        inputs = (lam, lamlu, Atot, dv, flu, threshold, nvj if threshold else None, np.dtype(self.dtype).str)
+        key = self.siglu_cache.key(*inputs)
+        siglu = self.siglu_cache.get(key)
+        if siglu is None:
+            siglu = self.siglu_cache.put(key, self._eval_siglu(lam, lamlu, Atot, dv, flu, threshold, nvj))
+        return siglu
+
+    def _eval_siglu(self, lam, lamlu, Atot, dv, flu, threshold=None, nvj=None):
+        """Evaluate the cross-sections of _calc_siglu, bypassing siglu_cache."""
+        if threshold:
+            sig0 = (np.sqrt(np.pi) * c.e.esu**2 / (c.m_e * c.c * dv) * flu * lamlu).to_value(u.cm**2)
+            threshold = np.full(len(lamlu), float(threshold))
+            if nvj is not None:
+                threshold = threshold * np.minimum(1, 1 / self.peak_tau(lamlu, Atot, dv, flu, nvj))
+            tiles = self._map_lines(self._voigt_rows, (lamlu, Atot, threshold, sig0), lam, dv)
+            return self._to_csr([row for rows in tiles for row in rows], len(lam))
+
+        return np.concatenate(self._map_lines(self._siglu_block, (lamlu, Atot, flu), lam, dv))
+
+    def peak_tau(self, lamlu, Atot, dv, flu, nvj):
+        """
+        Line-center optical depth of each transition.
+
+        Parameters
+        ----------
+        lamlu : astropy.units.Quantity
+            Line center wavelengths.
+        Atot : astropy.units.Quantity
+            Damping constants.
+        dv : astropy.units.Quantity
+            Doppler width.
+        flu : array
+            Oscillator strengths f_lu.
+        nvj : astropy.units.Quantity
+            Column densities of the lower levels.
+
+        Returns
+        -------
+        array
+            nvj * sigma_lu(lamlu), with H(a,0) = erfcx(a) (Eqs. 4 and 11, McJunkin et al. 2016).
+        """
+        sig0 = (np.sqrt(np.pi) * c.e.esu**2 / (c.m_e * c.c * dv) * flu * lamlu).to_value(u.cm**2)
+        a = (Atot * lamlu / (4 * np.pi * dv)).decompose().value
+        return nvj.to_value(u.cm**-2) * sig0 * erfcx(a)
+
+    def calc_line_tau(self, lam, lamlu, Atot, dv, flu, nvj, tau_min):
+        """
+        Optical depth of each line, truncated where it falls below tau_min.
+
+        Parameters
+        ----------
+        lam : astropy.units.Quantity
+            Wavelength grid.
+        lamlu : astropy.units.Quantity
+            Line center wavelengths.
+        Atot : astropy.units.Quantity
+            Damping constants.
+        dv : astropy.units.Quantity
+            Doppler width.
+        flu : array
+            Oscillator strengths f_lu.
+        nvj : astropy.units.Quantity
+            Column densities of the lower levels.
+        tau_min : float
+            Optical depth below which each line is truncated.
+
+        Returns
+        -------
+        scipy.sparse.csr_array
+            Optical depths of shape (n_lines, n_lam).
+        """
+        if len(lamlu) == 0:
+            return self._to_csr([], len(lam))
+        sig0 = (np.sqrt(np.pi) * c.e.esu**2 / (c.m_e * c.c * dv) * flu * lamlu).to_value(u.cm**2)
+        threshold = np.minimum(tau_min / self.peak_tau(lamlu, Atot, dv, flu, nvj), 0.5)
+        scale = nvj.to_value(u.cm**-2) * sig0
+        tiles = self._map_lines(self._voigt_rows, (lamlu, Atot, threshold, scale), lam, dv)
+        return self._to_csr([row for rows in tiles for row in rows], len(lam))
+
+    def _siglu_block(self, lamlu, Atot, flu, lam, dv):
+        """Dense cross-sections for one tile of lines, see _calc_siglu."""
+        siglu = np.zeros((len(lamlu), len(lam)), dtype=self.dtype) * u.cm**2
         for i in range(len(lamlu)):
             H_prof = self._voigt(lam, lamlu[i], Atot[i], dv)
             siglu[i, :] = (np.sqrt(np.pi) * c.e.esu**2 / (c.m_e * c.c * dv) * flu[i] * lamlu[i] * H_prof).to(u.cm**2)
         return siglu
 
-    def _calc_dv(self, instr=False):
+    def _map_lines(self, func, per_line, *args):
+        """
+        Apply func to contiguous tiles of lines, in parallel when N_WORKERS > 1.
+
+        Parameters
+        ----------
+        func : callable
+            Bound method called as func(*tile, *args), where tile holds the slices of per_line for one tile.
+        per_line : tuple of array
+            Arrays with one entry per line.
+        *args
+            Arguments shared by all tiles.
+
+        Returns
+        -------
+        list
+            Results of func in tile order, so assembling them does not depend on the number of workers.
+
+        Notes
+        -----
+        Tiles run on a thread pool, or on a process pool with PARALLEL_BACKEND = PROCESSES; worker processes get a
+        fresh BaseCalc so that cached matrices are not pickled. The pool of an enclosing _line_pool block is reused,
+        otherwise one is started for this call.
+        """
+        n_workers = int(self.constant.N_WORKERS)
+        n_lines = len(per_line[0])
+        if n_workers <= 1 or n_lines < 2:
+            return [func(*per_line, *args)]
+        if self._executor is None:
+            with self._line_pool():
+                return self._map_lines(func, per_line, *args)
+
+        bounds = np.linspace(0, n_lines, min(n_workers * TILES_PER_WORKER, n_lines) + 1).astype(int)
+        if self.constant.PARALLEL_BACKEND == "PROCESSES":
+            func = getattr(BaseCalc(self.constant), func.__name__)
+        futures = [
+            self._executor.submit(func, *[arr[start:stop] for arr in per_line], *args)
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+        return [future.result() for future in futures]
+
+    @contextlib.contextmanager
+    def _line_pool(self):
+        """Share one N_WORKERS pool between the _map_lines calls inside the block, e.g. those of all tiles."""
+        n_workers = int(self.constant.N_WORKERS)
+        if self._executor is not None or n_workers <= 1:
+            yield
+            return
+        if self.constant.PARALLEL_BACKEND == "PROCESSES":
+            self._executor = ProcessPoolExecutor(max_workers=n_workers)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=n_workers)
+        try:
+            with self._executor:
+                yield
+        finally:
+            self._executor = None
+
+    def _voigt_window(self, lam, lam0, gam, dv, threshold):
+        """
+        Find the part of the grid where H(a,y) can exceed threshold times its line-center value.
+
+        Parameters
+        ----------
+        lam : astropy.units.Quantity
+            Monotonically increasing wavelength grid.
+        lam0 : astropy.units.Quantity
+            Line center wavelength.
+        gam : astropy.units.Quantity
+            Damping constant Γ.
+        dv : astropy.units.Quantity
+            Doppler width.
+        threshold : float
+            Relative truncation threshold, 0 < threshold < 1.
+
+        Returns
+        -------
+        slice
+            Window of lam around the line.
+        float
+            Line-center value H(a,0).
+        """
+        half, h0 = self._voigt_halfwidth(lam0, gam, dv, threshold)
+        half = half.to_value(lam.unit)
+        lam0 = lam0.to_value(lam.unit)
+        start, stop = np.searchsorted(lam.value, [lam0 - half, lam0 + half])
+        return slice(max(start - 1, 0), stop + 1), h0
+
+    def _voigt_halfwidth(self, lam0, gam, dv, threshold):
+        """
+        Half-width of the wavelength range where H(a,y) can exceed threshold times its line-center value.
+
+        Parameters
+        ----------
+        lam0 : astropy.units.Quantity
+            Line center wavelength(s).
+        gam : astropy.units.Quantity
+            Damping constant(s) Γ.
+        dv : astropy.units.Quantity
+            Doppler width.
+        threshold : float
+            Relative truncation threshold, 0 < threshold < 1.
+
+        Returns
+        -------
+        astropy.units.Quantity
+            Half-width in the units of lam0.
+        float or array
+            Line-center value(s) H(a,0).
+
+        Notes
+        -----
+        Bounds the Doppler core exp(-y^2) and the Lorentzian wings a / (sqrt(pi) y^2) by threshold / 2 each, with
+        y = c |lam - lam0| / (dv lam0).
+        """
+        a = (gam * lam0 / (4 * np.pi * dv)).decompose().value
+        h0 = erfcx(a)
+        t = threshold * h0 / 2
+        y_cut = np.maximum(np.sqrt(-np.log(t)), np.sqrt(a / (np.sqrt(np.pi) * t)))
+        return (y_cut * dv / c.c * lam0).to(lam0.unit), h0
+
+    def _voigt_rows(self, lamlu, Atot, threshold, scale, lam, dv, normalize=False):
+        """
+        Evaluate truncated Voigt profiles line by line.
+
+        Parameters
+        ----------
+        lamlu : astropy.units.Quantity
+            Line center wavelengths.
+        Atot : astropy.units.Quantity
+            Damping constants.
+        threshold : array
+            Relative truncation threshold per line.
+        scale : array
+            Factor applied to each line's profile.
+        lam : astropy.units.Quantity
+            Wavelength grid.
+        dv : astropy.units.Quantity
+            Doppler width.
+        normalize : bool, optional
+            Normalize each truncated profile to unit area over lam (in Å), by default False
+
+        Returns
+        -------
+        list of tuple
+            For each line, the grid indices where the profile is kept and the scaled H(a,y) at those indices.
+        """
+        rows = []
+        for i in range(len(lamlu)):
+            window, h0 = self._voigt_window(lam, lamlu[i], Atot[i], dv, threshold[i])
+            H_prof = np.asarray(self._voigt(lam[window], lamlu[i], Atot[i], dv))
+            keep = np.flatnonzero(H_prof >= threshold[i] * h0)
+            cols, H_prof = keep + window.start, H_prof[keep]
+            if normalize:
+                H_prof = H_prof / np.trapezoid(H_prof, lam[cols]).value
+            rows.append((cols, scale[i] * H_prof))
+        return rows
+
+    def _to_csr(self, rows, n_cols):
+        """
+        Assemble (columns, values) pairs into a scipy.sparse CSR array with one row per pair.
+        """
+        indptr = np.cumsum([0] + [len(cols) for cols, _ in rows])
+        indices = np.concatenate([cols for cols, _ in rows]) if rows else np.zeros(0, dtype=int)
+        data = np.concatenate([values for _, values in rows]).astype(self.dtype) if rows else np.zeros(0, self.dtype)
+        return sparse.csr_array((data, indices, indptr), shape=(len(rows), n_cols))
+
+    def _calc_dv(self, instr=False, T=None, b=None):
         """
         Compute total Doppler width dv: thermal + non-thermal [+ instrumental].
 
         Parameters
         ----------
-        T : astropy.units.Quantity
-            Kinetic temperature (thermal component).
-        b : astropy.units.Quantity
-            Non-thermal Doppler b-value.
-        R : float or None
-            Instrument resolving power.
         instr : bool
-            If True and R provided, include instrumental broadening.
+            If True and RESOLVING_POWER is set, include instrumental broadening.
+        T : astropy.units.Quantity, optional
+            Kinetic temperature (thermal component), by default TH2.
+        b : astropy.units.Quantity, optional
+            Non-thermal Doppler b-value, by default VELOCITY_DISPERSION.
 
         Returns
         -------
         astropy.units.Quantity
             Combined Doppler width (same units as c.c).
         """
-        dv_therm = np.sqrt(2 * c.k_B * self.constant.TH2 / (2 * c.m_p))  # Thermal broadening
-        dv_nontherm = self.constant.VELOCITY_DISPERSION  # Non-thermal broadening
+        T = self.constant.TH2 if T is None else T
+        b = self.constant.VELOCITY_DISPERSION if b is None else b
+        dv_therm = np.sqrt(2 * c.k_B * T / (2 * c.m_p))  # Thermal broadening
+        dv_nontherm = b  # Non-thermal broadening
         if instr and self.constant.RESOLVING_POWER:  # Instrumental broadening
             dv_instr = c.c / (self.constant.RESOLVING_POWER * np.sqrt(8 * np.log(2)))
             return np.sqrt(dv_therm**2 + dv_nontherm**2 + dv_instr**2)
         return np.sqrt(dv_therm**2 + dv_nontherm**2)
+
+
+def _cell_edges(x):
+    """Edges of the cells around the points of an increasing grid: midpoints, extended by half a step at the ends."""
+    mid = (x[1:] + x[:-1]) / 2
+    return np.concatenate([[x[0] - (mid[0] - x[0])], mid, [x[-1] + (x[-1] - mid[-1])]])
+
+
+@functools.lru_cache(maxsize=8)
+def level_energies(vmax, jmax):
+    """Ro-vibrational energies E(v, J) in eV of all levels up to vmax, jmax from BaseCalc._calc_e, read-only."""
+    energies = BaseCalc._calc_e(np.arange(vmax + 1), np.arange(jmax + 1)).to_value(u.eV)
+    energies.flags.writeable = False
+    return energies
+
+
+@functools.lru_cache(maxsize=8)
+def population_table(vmax, jmax):
+    """Partition function and normalized level populations of H2 on the log-temperature grid.
+
+    Parameters
+    ----------
+    vmax : int
+        Highest vibrational level.
+    jmax : int
+        Highest rotational level.
+
+    Returns
+    -------
+    array
+        Temperatures in K, POPULATION_TMIN to POPULATION_TMAX.
+    array
+        Natural log of the partition function sum exp(-E(v, J) / kT) at each temperature.
+    array
+        Natural log of the normalized populations, shape (n_temperatures, vmax + 1, jmax + 1).
+    """
+    decades = np.log10(POPULATION_TMAX / POPULATION_TMIN)
+    temperatures = np.logspace(
+        np.log10(POPULATION_TMIN), np.log10(POPULATION_TMAX), int(round(decades * POPULATION_POINTS_PER_DEX)) + 1
+    )
+    exponents = -level_energies(vmax, jmax) / (c.k_B.to_value(u.eV / u.K) * temperatures[:, None, None])
+    log_z = logsumexp(exponents, axis=(1, 2))
+    log_populations = exponents - log_z[:, None, None]
+    for array in (temperatures, log_z, log_populations):
+        array.flags.writeable = False
+    return temperatures, log_z, log_populations
+
+
+@functools.lru_cache(maxsize=POPULATION_CACHE_SIZE)
+def level_populations(vmax, jmax, T, table=True):
+    """Normalized Boltzmann populations exp(-E(v, J) / kT) / Z of all H2 levels up to vmax, jmax.
+
+    Parameters
+    ----------
+    vmax : int
+        Highest vibrational level.
+    jmax : int
+        Highest rotational level.
+    T : float
+        Temperature in K.
+    table : bool, optional
+        Interpolate in the population table, by default True. Temperatures outside the table are computed exactly.
+
+    Returns
+    -------
+    array
+        Populations of shape (vmax + 1, jmax + 1) summing to 1, read-only.
+
+    Notes
+    -----
+    The log populations are interpolated linearly in 1 / T, in which -E / kT is exactly linear, so that only the
+    curvature of log Z contributes to the error, below 1e-10 relative on the default grid. Results are kept for the
+    last POPULATION_CACHE_SIZE temperatures.
+    """
+    temperatures, _, log_populations = population_table(vmax, jmax)
+    if table and temperatures[0] <= T <= temperatures[-1]:
+        i = min(np.searchsorted(temperatures, T, side="right") - 1, len(temperatures) - 2)
+        w = (1 / T - 1 / temperatures[i]) / (1 / temperatures[i + 1] - 1 / temperatures[i])
+        populations = np.exp((1 - w) * log_populations[i] + w * log_populations[i + 1])
+        populations /= populations.sum()
+    else:
+        exponents = -level_energies(vmax, jmax) / (c.k_B.to_value(u.eV / u.K) * T)
+        populations = np.exp(exponents - logsumexp(exponents))
+    populations.flags.writeable = False
+    return populations
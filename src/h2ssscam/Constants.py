@@ -1,13 +1,27 @@
 import astropy.units as u
 import os
+from dataclasses import dataclass
+from astropy.units import Quantity
 from .data_loader import load_config_files
 from datetime import datetime
 
 
+@dataclass
+class Component:
+    """A single H2 velocity component along the sightline."""
+
+    NH2_TOT: Quantity
+    TH2: Quantity
+    VELOCITY_DISPERSION: Quantity
+    DOPPLER_SHIFT: Quantity
+
+
 class Constants:
     
-    def __init__(self, user_config_path: str | None = None):
+    def __init__(self, user_config_path: str | None = None, overrides: dict | None = None):
         self.config = self.read_config_files(user_config_path)
+        for parameter_name, value in (overrides or {}).items():
+            self._set_value(parameter_name.lower(), value)
         self.CU_UNIT = u.ph * u.cm**-2 * u.s**-1 * u.sr**-1 * u.AA**-1
         self.ERG_UNIT = u.erg * u.cm**-2 * u.s**-1 * u.arcsec**-2 * u.nm**-1
 
@@ -15,17 +29,45 @@ class Constants:
         # max vibrational (v) and rotational (J) levels for Lyman–Werner bands
         self.VMAX = self.value("vmax")
         self.JMAX = self.value("jmax")
+        # H2 level populations; can be 'ON' (interpolated in a temperature table) or 'OFF' (exact)
+        self.POPULATION_TABLE = self.value("population_table", parameter_type=str)
         # model bandpass lambda in [1380,1620] angstroms
         self.BP_MIN = self.value("bp_min") * u.AA
         self.BP_MAX = self.value("bp_max") * u.AA
         # A_ul/A_tot threshold to include a transition
         self.LINE_STRENGTH_CUTOFF = self.value("line_strength_cutoff")
+        # line selection; can be 'CUTOFF' (NH2_CUTOFF and LINE_STRENGTH_CUTOFF) or 'AUTO' (FLUX_TOLERANCE)
+        self.LINE_SELECTION = self.value("line_selection", parameter_type=str)
+        # maximum fraction of the in-band emitted flux that 'AUTO' line selection may discard
+        self.FLUX_TOLERANCE = self.value("flux_tolerance")
+        # photodissociation-rate output; can be 'ON' or 'OFF'
+        self.DISSOCIATION = self.value("dissociation", parameter_type=str)
+        # breakdown of the emission spectrum; can be 'NONE', 'BAND', 'VU' or 'PUMP'
+        self.SPEC_GROUPS = self.value("spec_groups", parameter_type=str)
         # instrument resolving power, None = ignore instrumental broadening
         self.RESOLVING_POWER = self.value("resolving_power")
         # plotting units; can be 'CU' or 'ERGS'
         self.UNIT = self.value("unit", parameter_type=str)
-        # wavelength sampling
-        self.DLAM = self.value("dlam") * u.AA
+        # wavelength sampling of the emergent spectrum in angstroms, or 'AUTO' to sample the narrowest line width
+        self.DLAM = self.auto_value("dlam", u.AA)
+        # wavelength sampling of the source (absorption) spectrum in angstroms, or 'AUTO'
+        self.SOURCE_DLAM = self.auto_value("source_dlam", u.AA)
+        # samples per FWHM of the narrowest line profile for 'AUTO' wavelength sampling
+        self.SAMPLES_PER_FWHM = self.value("samples_per_fwhm")
+        # relative threshold below which line profiles are truncated and stored as sparse matrices; 0 = dense
+        self.SPARSE_THRESHOLD = self.value("sparse_threshold")
+        # storage precision of cross-sections, optical depths and line profiles; can be 'DOUBLE' or 'SINGLE'
+        self.PRECISION = self.value("precision", parameter_type=str)
+        # number of workers for the per-line profile calculations; 1 = serial
+        self.N_WORKERS = int(self.value("n_workers"))
+        # parallel backend; can be 'THREADS' or 'PROCESSES'
+        self.PARALLEL_BACKEND = self.value("parallel_backend", parameter_type=str)
+        # wavelength points per tile for out-of-core synthesis of the emergent spectrum; 0 = whole grid at once
+        self.TILE_SIZE = int(self.value("tile_size"))
+        # directory of the content-hashed result cache; empty = always recompute
+        self.RESULT_CACHE_DIR = self.value("result_cache_dir", parameter_type=str)
+        # size limit of the result cache in MB; least recently used results are evicted beyond it
+        self.RESULT_CACHE_MAX_MB = self.value("result_cache_max_mb")
 
         # H₂ GAS PARAMETERS
         # kinetic temperature of H2 gas
@@ -47,6 +89,10 @@ class Constants:
         # incident source; can be 'BLACKBODY' or 'ISRF'
         self.INC_SOURCE = self.value("inc_source", parameter_type=str)
 
+        # H₂ VELOCITY COMPONENTS
+        # one per [COMPONENT_*] section; defaults to a single component built from the H₂ gas parameters
+        self.COMPONENTS = self.read_components()
+
     def value(self, parameter_name, parameter_type=float):
         """
         Load a parameter value from the configparser and transform it to float if required
@@ -75,6 +121,58 @@ class Constants:
             return float(parameter)
         return parameter
 
+    def auto_value(self, parameter_name, unit):
+        """
+        Load a parameter that is either a number or 'AUTO'
+
+        Parameters
+        ----------
+        parameter_name : str
+            Name of a parameter
+        unit : astropy.units.Unit
+            Unit attached to numeric values
+
+        Returns
+        -------
+        str | Quantity
+            'AUTO' or the value with its unit
+        """
+        parameter = self.value(parameter_name, parameter_type=str)
+        if parameter.upper() == "AUTO":
+            return "AUTO"
+        return float(parameter) * unit
+
+    def read_components(self):
+        """
+        Build the list of H2 velocity components from the [COMPONENT_*] sections of the config
+
+        Each section may set NH2_TOT, TH2, VELOCITY_DISPERSION and DOPPLER_SHIFT; parameters missing from a
+        section fall back to the values in [PARAMETERS].
+
+        Returns
+        -------
+        list of Component
+            Components in the order in which they appear in the config files
+        """
+        sections = [name for name in self.config.sections() if name.upper().startswith("COMPONENT")]
+        if not sections:
+            return [Component(self.NH2_TOT, self.TH2, self.VELOCITY_DISPERSION, self.DOPPLER_SHIFT)]
+
+        components = []
+        for name in sections:
+            section = self.config[name]
+            components.append(
+                Component(
+                    NH2_TOT=float(section.get("nh2_tot", self.NH2_TOT.value)) * u.cm**-2,
+                    TH2=float(section.get("th2", self.TH2.value)) * u.K,
+                    VELOCITY_DISPERSION=float(section.get("velocity_dispersion", self.VELOCITY_DISPERSION.value))
+                    * u.km
+                    / u.s,
+                    DOPPLER_SHIFT=float(section.get("doppler_shift", self.DOPPLER_SHIFT.value)) * u.km / u.s,
+                )
+            )
+        return components
+
     def _set_value(self, parameter_name, value):
         """
         Updates value in configparser
@@ -127,6 +225,11 @@ class Constants:
         """
         for key in self.config["PARAMETERS"]:
             self._set_value(key, getattr(self, key.upper()))
+        sections = [name for name in self.config.sections() if name.upper().startswith("COMPONENT")]
+        if sections:
+            for name, component in zip(sections, self.COMPONENTS):
+                for key in self.config[name]:
+                    self.config[name][key] = str(getattr(component, key.upper()).value)
         timestamp = datetime.now().strftime("%y%m%d_%H%M%S")
         output_file = os.path.join(output_path, f"config_{timestamp}.ini")
 
@@ -0,0 +1,180 @@
+"""
+Batch runner: evaluate many models in parallel worker processes that share one copy of the line data.
+
+The line lists are loaded and preprocessed once in the parent and published through
+multiprocessing.shared_memory; workers attach to them without copying.
+
+Usage: python -m h2ssscam.batch [config file] --set TH2=100,300,500 --set NH2_TOT=1e19,1e20 [--workers N]
+       [--store DIRECTORY [--compress]]
+"""
+import argparse
+import itertools
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import astropy.units as u
+import numpy as np
+from h2ssscam.Constants import Constants
+from h2ssscam.grid_store import GridStore
+from h2ssscam.model import load_lines, restrict_lines, run_cached, save_result
+
+# Line lists attached by a worker process, and the shared memory blocks that back them
+_worker_lines = None
+_worker_blocks = []
+
+
+class SharedLines:
+    """Line lists from load_lines published in shared memory.
+
+    Parameters
+    ----------
+    lines : dict
+        Line lists from load_lines.
+
+    Attributes
+    ----------
+    descriptor : dict
+        Picklable description (block name, shape, dtype, unit) of every array, passed to SharedLines.attach.
+    """
+
+    def __init__(self, lines):
+        self._blocks = []
+        self.descriptor = {}
+        for group, arrays in lines.items():
+            self.descriptor[group] = {}
+            for key, value in arrays.items():
+                unit = value.unit.to_string() if isinstance(value, u.Quantity) else None
+                array = np.asarray(value.value if unit is not None else value)
+                if array.dtype == object:
+                    array = array.astype(np.bytes_)
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+                self._blocks.append(block)
+                self.descriptor[group][key] = (block.name, array.shape, array.dtype.str, unit)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Release and remove the shared memory blocks."""
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    @staticmethod
+    def attach(descriptor):
+        """Map shared line lists into the current process without copying.
+
+        Parameters
+        ----------
+        descriptor : dict
+            SharedLines.descriptor of the publishing process.
+
+        Returns
+        -------
+        dict
+            Read-only line lists in the layout of load_lines.
+        list
+            Attached shared memory blocks; they must stay referenced while the line lists are in use.
+        """
+        lines, blocks = {}, []
+        for group, arrays in descriptor.items():
+            lines[group] = {}
+            for key, (name, shape, dtype, unit) in arrays.items():
+                if sys.version_info >= (3, 13):
+                    block = shared_memory.SharedMemory(name=name, track=False)
+                else:
+                    block = shared_memory.SharedMemory(name=name)
+                array = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+                array.flags.writeable = False
+                lines[group][key] = array if unit is None else u.Quantity(array, unit, copy=False)
+                blocks.append(block)
+        return lines, blocks
+
+
+def run_batch(overrides, user_config_path=None, n_workers=None, output_dir=".", store=None):
+    """Run one model per set of parameter overrides in a pool of worker processes.
+
+    Parameters
+    ----------
+    overrides : list of dict
+        Parameter values (by config name) applied on top of the config files for each model.
+    user_config_path : str, optional
+        Config file shared by all models, by default the package defaults.
+    n_workers : int, optional
+        Number of worker processes, by default os.cpu_count().
+    output_dir : str, optional
+        Directory for the saved spectra, by default the current directory
+    store : GridStore, optional
+        Append the spectra to this store instead of saving one file per model.
+
+    Returns
+    -------
+    list of str or list of int
+        Paths of the saved spectra, or their model numbers in store, in the order of overrides.
+    """
+    # load once for the widest line selection of the batch
+    constants = [Constants(user_config_path, override) for override in overrides]
+    widest = {"vmax": max(c.VMAX for c in constants), "jmax": max(c.JMAX for c in constants)}
+    lines = load_lines(Constants(user_config_path, widest))
+
+    with SharedLines(lines) as shared:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_attach, initargs=(shared.descriptor,)) as pool:
+            save = store is None
+            futures = [pool.submit(_run_one, user_config_path, override, output_dir, save) for override in overrides]
+            if save:
+                return [future.result() for future in futures]
+            return [store.append(constant, future.result()) for constant, future in zip(constants, futures)]
+
+
+def _attach(descriptor):
+    """Worker initializer: attach to the shared line lists."""
+    global _worker_lines, _worker_blocks
+    _worker_lines, _worker_blocks = SharedLines.attach(descriptor)
+
+
+def _run_one(user_config_path, override, output_dir, save=True):
+    """Run a single model in a worker process and save it, or return it to the parent for storing."""
+    constant = Constants(user_config_path, override)
+    result = run_cached(constant, restrict_lines(_worker_lines, constant))
+    return save_result(constant, result, output_dir) if save else result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a grid of h2ssscam models in parallel.")
+    parser.add_argument("config", nargs="?", default=None, help="config file shared by all models")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=V1,V2,...",
+        help="values of a parameter; models are run for every combination",
+    )
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--output", default=".", help="directory for the saved spectra")
+    parser.add_argument("--store", default=None, help="append the spectra to a grid store in this directory")
+    parser.add_argument("--compress", action="store_true", help="compress full shards of a new grid store")
+    args = parser.parse_args()
+
+    names, values = [], []
+    for item in args.set:
+        name, _, value_list = item.partition("=")
+        names.append(name.strip())
+        values.append([value.strip() for value in value_list.split(",")])
+    overrides = [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+    if args.store is None:
+        for path in run_batch(overrides, args.config, args.workers, args.output):
+            print(f"Model saved as {path}")
+        return
+    with GridStore(args.store, compression="ZLIB" if args.compress else None) as store:
+        models = run_batch(overrides, args.config, args.workers, store=store)
+    print(f"Models {models[0]}-{models[-1]} appended to {args.store}")
+
+
+if __name__ == "__main__":
+    main()
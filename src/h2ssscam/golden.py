@@ -0,0 +1,307 @@
+"""
+Golden-spectrum accuracy harness: reference outputs of the exact model path for a set of representative configs,
+and comparison of alternative engines (fast-path parameter settings) against them.
+
+An engine is a set of parameter overrides applied on top of every reference config, e.g. {"SPARSE_THRESHOLD": 1e-6}
+or {"PRECISION": "SINGLE", "LINE_SELECTION": "AUTO"}.
+
+Usage: python -m h2ssscam.golden generate [directory] [--base CONFIG] [--only NAME ...]
+       python -m h2ssscam.golden compare [directory] --set NAME=VALUE ... [--tolerance METRIC=VALUE ...]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import astropy.units as u
+import numpy as np
+from scipy import sparse
+from h2ssscam.BaseCalc import BaseCalc
+from h2ssscam.Constants import Constants
+from h2ssscam.model import load_lines, run_model
+from h2ssscam.result_cache import code_version, line_list_version
+
+# Representative configs, as overrides of the base config
+REFERENCE_CONFIGS = {
+    "default": {},
+    "cold_thin": {"TH2": 100, "NH2_TOT": 1e18},
+    "hot_thick": {"TH2": 2000, "NH2_TOT": 1e21},
+    "isrf": {"INC_SOURCE": "ISRF", "THI": 10000},
+    "shifted_narrow": {"DOPPLER_SHIFT": -11.4, "VELOCITY_DISPERSION": 3},
+}
+
+# Parameters that select the exact path for the reference outputs
+EXACT_PATH = {
+    "LINE_SELECTION": "CUTOFF",
+    "SPARSE_THRESHOLD": 0,
+    "PRECISION": "DOUBLE",
+    "TILE_SIZE": 0,
+    "POPULATION_TABLE": "OFF",
+}
+
+# Number of strongest absorbing H2 transitions whose cross-sections are kept
+SIGLU_LINES = 20
+
+# Default pass/fail tolerance of every metric
+DEFAULT_TOLERANCES = {
+    "siglu": 1e-3,
+    "tau_tot": 1e-3,
+    "abs_rate_per_trans": 1e-3,
+    "spec": 1e-3,
+    "spec_tot": 1e-3,
+    "spec_flux": 1e-3,
+    "spec_tot_flux": 1e-3,
+    "line_flux": 1e-3,
+}
+
+
+def model_outputs(constant, lines, siglu_lines=None, lam=None):
+    """Run the model and collect the outputs compared by the harness.
+
+    Parameters
+    ----------
+    constant : Constants
+        Model parameters.
+    lines : dict
+        Line lists from load_lines.
+    siglu_lines : array, optional
+        Indices into the H2 line list whose cross-sections are kept, by default the SIGLU_LINES strongest absorbers.
+    lam : astropy.units.Quantity, optional
+        Wavelength grid of the kept cross-sections, by default the source grid of the run.
+
+    Returns
+    -------
+    dict
+        Plain float64 arrays: lam, tau_tot, lam_shifted, spec, spec_tot, abs_rate_per_trans, flux_per_line, and
+        siglu (cm^2) of siglu_lines on siglu_lam.
+    float
+        Run time of the model in s.
+    """
+    basecalc = BaseCalc(constant)
+    start = time.perf_counter()
+    result = run_model(constant, lines, basecalc)
+    elapsed = time.perf_counter() - start
+
+    units = result["units"]
+    abs_rate = result["abs_rate_per_trans"].to_value(units)
+    if siglu_lines is None:
+        siglu_lines = np.sort(np.argsort(abs_rate.sum(axis=0))[::-1][:SIGLU_LINES])
+    lam = result["lam"] if lam is None else lam
+
+    # cross-sections of the kept lines through the engine's own siglu path (truncation, precision)
+    h2, component = lines["h2"], constant.COMPONENTS[0]
+    nvj = basecalc.calc_nvj(component.NH2_TOT, component.TH2)[h2["vl"][siglu_lines], h2["jl"][siglu_lines]]
+    dv = basecalc._calc_dv(T=component.TH2, b=component.VELOCITY_DISPERSION)
+    siglu = basecalc._calc_siglu(
+        lam,
+        h2["lamlu"][siglu_lines],
+        h2["Atot"][siglu_lines],
+        dv,
+        h2["flu"][siglu_lines],
+        constant.SPARSE_THRESHOLD,
+        nvj,
+    )
+    siglu = siglu.toarray() if sparse.issparse(siglu) else siglu.to_value(u.cm**2)
+
+    outputs = {
+        "lam": result["lam"].to_value(u.AA),
+        "tau_tot": np.asarray(u.Quantity(basecalc._tau_tot).value, dtype=np.float64),
+        "lam_shifted": result["lam_shifted"].to_value(u.AA),
+        "spec": result["spec"].to_value(units),
+        "spec_tot": result["spec_tot"].to_value(units),
+        "abs_rate_per_trans": abs_rate,
+        "flux_per_line": result["flux_per_line"].to_value(units),
+        "siglu_lines": np.asarray(siglu_lines),
+        "siglu_lam": lam.to_value(u.AA),
+        "siglu": np.asarray(siglu, dtype=np.float64),
+    }
+    return outputs, elapsed
+
+
+def generate(directory, user_config_path=None, configs=None):
+    """Compute and store reference outputs of the exact path.
+
+    Parameters
+    ----------
+    directory : str
+        Directory for the references, created if missing.
+    user_config_path : str, optional
+        Base config that the reference configs override, by default the package defaults.
+    configs : dict, optional
+        Reference configs by name, as parameter overrides, by default REFERENCE_CONFIGS.
+
+    Returns
+    -------
+    dict
+        Stored metadata of every reference: overrides, run time, units and the line-list and code versions.
+    """
+    configs = REFERENCE_CONFIGS if configs is None else configs
+    os.makedirs(directory, exist_ok=True)
+    index = _read_index(directory)
+    for name, overrides in configs.items():
+        constant = Constants(user_config_path, {**overrides, **EXACT_PATH})
+        outputs, elapsed = model_outputs(constant, load_lines(constant))
+        np.savez_compressed(os.path.join(directory, f"{name}.npz"), **outputs)
+        index[name] = {
+            "overrides": overrides,
+            "base_config": user_config_path,
+            "time_s": elapsed,
+            "units": constant.UNIT,
+            "lines": line_list_version(),
+            "code": code_version(),
+        }
+        with open(os.path.join(directory, "golden.json"), "w") as file:
+            json.dump(index, file, indent=1)
+    return index
+
+
+def compare(directory, engine, user_config_path=None, tolerances=None, names=None):
+    """Compare an alternative engine against stored references.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of references from generate.
+    engine : dict
+        Parameter overrides selecting the engine, applied on top of each reference config and EXACT_PATH.
+    user_config_path : str, optional
+        Base config, by default the one the references were generated with.
+    tolerances : dict, optional
+        Pass/fail tolerances by metric, merged into DEFAULT_TOLERANCES.
+    names : list of str, optional
+        References to compare, by default all.
+
+    Returns
+    -------
+    list of dict
+        Per reference: config name, errors by metric, failed metrics, passed, and the run times of the engine and
+        the reference in s.
+
+    Notes
+    -----
+    Metrics (all relative, 0 for identical outputs):
+
+    - siglu: max over the kept lines of max |d siglu| / peak siglu of the line
+    - tau_tot: max |d tau| / max(tau, 1), i.e. relative where optically thick and absolute where thin
+    - abs_rate_per_trans, spec, spec_tot: max |d| / max |reference|
+    - spec_flux, spec_tot_flux: |d integral| / integral over wavelength
+    - line_flux: max |d flux| of a single emission line / total emitted flux
+
+    Outputs on a different wavelength grid than the reference are interpolated onto the reference grid.
+    """
+    tolerances = {**DEFAULT_TOLERANCES, **(tolerances or {})}
+    index = _read_index(directory)
+    reports = []
+    for name in names or list(index):
+        meta = index[name]
+        base = meta["base_config"] if user_config_path is None else user_config_path
+        with np.load(os.path.join(directory, f"{name}.npz")) as data:
+            reference = {key: data[key] for key in data.files}
+        constant = Constants(base, {**meta["overrides"], **EXACT_PATH, **engine})
+        outputs, elapsed = model_outputs(
+            constant, load_lines(constant), reference["siglu_lines"], reference["siglu_lam"] * u.AA
+        )
+        errors = _errors(reference, outputs)
+        failed = [metric for metric, error in errors.items() if not error <= tolerances[metric]]
+        reports.append(
+            {
+                "config": name,
+                "errors": errors,
+                "failed": failed,
+                "passed": not failed,
+                "time_s": elapsed,
+                "reference_time_s": meta["time_s"],
+            }
+        )
+    return reports
+
+
+def _errors(reference, outputs):
+    """Error metrics of outputs against reference, see compare."""
+    resampled = {
+        "tau_tot": _on_grid(reference["lam"], outputs["lam"], outputs["tau_tot"]),
+        "spec": _on_grid(reference["lam_shifted"], outputs["lam_shifted"], outputs["spec"]),
+        "spec_tot": _on_grid(reference["lam_shifted"], outputs["lam_shifted"], outputs["spec_tot"]),
+    }
+    lam = reference["lam_shifted"]
+    siglu_peak = np.max(reference["siglu"], axis=1, keepdims=True)
+    errors = {
+        "siglu": np.max(np.abs(outputs["siglu"] - reference["siglu"]) / siglu_peak),
+        "tau_tot": np.max(np.abs(resampled["tau_tot"] - reference["tau_tot"]) / np.maximum(reference["tau_tot"], 1)),
+    }
+    errors["abs_rate_per_trans"] = _max_rel(reference["abs_rate_per_trans"], outputs["abs_rate_per_trans"])
+    for key in ("spec", "spec_tot"):
+        errors[key] = _max_rel(reference[key], resampled[key])
+        integral = np.trapezoid(reference[key], lam)
+        errors[f"{key}_flux"] = abs(np.trapezoid(resampled[key], lam) - integral) / abs(integral)
+    line_flux = reference["flux_per_line"]
+    errors["line_flux"] = np.max(np.abs(outputs["flux_per_line"] - line_flux)) / line_flux.sum()
+    return {metric: float(error) for metric, error in errors.items()}
+
+
+def _max_rel(reference, values):
+    """max |values - reference| / max |reference|."""
+    return np.max(np.abs(values - reference)) / np.max(np.abs(reference))
+
+
+def _on_grid(lam_ref, lam, values):
+    """values on lam_ref, interpolated if the grids differ."""
+    if len(lam) == len(lam_ref) and np.array_equal(lam, lam_ref):
+        return values
+    return np.interp(lam_ref, lam, values, left=0, right=0)
+
+
+def _read_index(directory):
+    path = os.path.join(directory, "golden.json")
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def _parse_assignments(items, value_type=str):
+    """NAME=VALUE strings from the command line as a dict."""
+    assignments = {}
+    for item in items:
+        name, _, value = item.partition("=")
+        assignments[name.strip()] = value_type(value.strip())
+    return assignments
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate golden h2ssscam spectra or compare an engine with them.")
+    parser.add_argument("command", choices=("generate", "compare"))
+    parser.add_argument("directory", help="directory of the reference outputs")
+    parser.add_argument("--base", default=None, help="base config file that the reference configs override")
+    parser.add_argument("--only", nargs="+", default=None, metavar="NAME", help="reference configs to use")
+    parser.add_argument(
+        "--set", action="append", default=[], metavar="NAME=VALUE", help="engine parameter (compare only)"
+    )
+    parser.add_argument(
+        "--tolerance", action="append", default=[], metavar="METRIC=VALUE", help="pass/fail tolerance of a metric"
+    )
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        configs = {name: REFERENCE_CONFIGS[name] for name in args.only} if args.only else None
+        for name, meta in generate(args.directory, args.base, configs).items():
+            print(f"{name:<16} {meta['time_s']:8.2f} s")
+        return
+
+    engine = _parse_assignments(args.set)
+    reports = compare(args.directory, engine, args.base, _parse_assignments(args.tolerance, float), args.only)
+    metrics = list(DEFAULT_TOLERANCES)
+    print(f"{'config':<16} " + " ".join(f"{metric:>18}" for metric in metrics) + f" {'time (s)':>9} {'speedup':>8}")
+    for report in reports:
+        errors = " ".join(
+            f"{report['errors'][metric]:17.2e}{'!' if metric in report['failed'] else ' '}" for metric in metrics
+        )
+        speedup = report["reference_time_s"] / report["time_s"]
+        print(f"{report['config']:<16} {errors} {report['time_s']:9.2f} {speedup:8.2f}")
+    passed = all(report["passed"] for report in reports)
+    print("PASSED" if passed else "FAILED (! marks metrics over tolerance)")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
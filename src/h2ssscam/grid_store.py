@@ -0,0 +1,263 @@
+"""
+Chunked, appendable store for grids of model spectra.
+
+A store is a directory holding the common wavelength grid, fixed-shape shards of spectra (one row per model) and an
+index table of the model parameters:
+
+    store.json            wavelength grid length, units, shard size and compression
+    lam.npy               wavelength grid in angstroms
+    index.jsonl           one line per model: model number, result key and parameter set
+    spec_00000.npy        shard_size x len(lam) rows of spec, memory-mappable
+    spec_tot_00000.npy    the same for spec_tot
+
+With compression, shards are byte-shuffled and zlib-compressed (spec_00000.npy.z) once they are full; the shard being
+filled always stays a plain .npy file.
+"""
+import json
+import os
+import zlib
+import astropy.units as u
+import numpy as np
+from h2ssscam.result_cache import parameter_set, result_key
+
+# Spectra kept for every model
+STORE_FIELDS = ("spec", "spec_tot")
+
+# zlib level used for compressed shards; byte shuffling does most of the work, so the fastest level suffices
+COMPRESSION_LEVEL = 1
+
+
+class GridStore:
+    """Directory of model spectra on a common wavelength grid.
+
+    Parameters
+    ----------
+    directory : str
+        Store directory; an existing store is opened for reading and appending.
+    shard_size : int, optional
+        Number of models per shard of a new store, by default 64
+    compression : str, optional
+        'ZLIB' to compress full shards of a new store, by default None (plain, memory-mappable shards)
+    """
+
+    def __init__(self, directory, shard_size=64, compression=None):
+        self.directory = directory
+        meta_path = os.path.join(directory, "store.json")
+        if os.path.isfile(meta_path):
+            with open(meta_path) as file:
+                self.meta = json.load(file)
+        else:
+            if compression not in (None, "ZLIB"):
+                raise ValueError(f"Unknown compression {compression}, use None or 'ZLIB'")
+            self.meta = {"n_lam": None, "units": None, "shard_size": int(shard_size), "compression": compression}
+        self._index = []
+        index_path = os.path.join(directory, "index.jsonl")
+        if os.path.isfile(index_path):
+            with open(index_path) as file:
+                self._index = [json.loads(line) for line in file if line.strip()]
+        self._shard = None  # (shard number, {field: memmap}) of the shard being filled
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def lam(self):
+        """Wavelength grid shared by all models."""
+        return np.load(os.path.join(self.directory, "lam.npy"), mmap_mode="r") * u.AA
+
+    @property
+    def units(self):
+        """Units of the stored spectra."""
+        return u.Unit(self.meta["units"])
+
+    def table(self):
+        """Index table: model number, result key and parameter set of every stored model."""
+        return list(self._index)
+
+    def append(self, constant, result):
+        """Append one model to the store.
+
+        Parameters
+        ----------
+        constant : Constants
+            Model parameters, recorded in the index table.
+        result : dict
+            Output of run_model.
+
+        Returns
+        -------
+        int
+            Model number within the store.
+
+        Raises
+        ------
+        ValueError
+            If the wavelength grid differs from that of the models already stored.
+        """
+        lam = result["lam_shifted"].to_value(u.AA)
+        if self.meta["n_lam"] is None:
+            os.makedirs(self.directory, exist_ok=True)
+            np.save(os.path.join(self.directory, "lam.npy"), lam)
+            self.meta.update(n_lam=len(lam), units=result["units"].to_string())
+            with open(os.path.join(self.directory, "store.json"), "w") as file:
+                json.dump(self.meta, file)
+        elif len(lam) != self.meta["n_lam"] or not np.array_equal(lam, self.lam.value):
+            raise ValueError("All models in a store must share one wavelength grid (set a fixed DLAM)")
+
+        model = len(self._index)
+        shard, row = divmod(model, self.meta["shard_size"])
+        arrays = self._open_shard(shard)
+        for field in STORE_FIELDS:
+            arrays[field][row] = result[field].to_value(self.units)
+            arrays[field].flush()
+
+        # the index line makes the model visible, so it is written after the spectra
+        entry = {"model": model, "key": result_key(constant), "parameters": parameter_set(constant)}
+        with open(os.path.join(self.directory, "index.jsonl"), "a") as file:
+            file.write(json.dumps(entry) + "\n")
+        self._index.append(entry)
+
+        if row == self.meta["shard_size"] - 1:
+            self._close_shard()
+        return model
+
+    def close(self):
+        """Finish the shard being filled; a partially filled shard stays uncompressed so it can still be appended to."""
+        if self._shard is not None:
+            for array in self._shard[1].values():
+                array.flush()
+            self._shard = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def find(self, constant=None, **parameters):
+        """Model numbers matching a parameter set.
+
+        Parameters
+        ----------
+        constant : Constants, optional
+            Match models with exactly these parameters.
+        **parameters
+            Match models with these parameter values (by config name, in config units), e.g. th2=300.
+
+        Returns
+        -------
+        list of int
+            Matching model numbers.
+        """
+        key = result_key(constant) if constant is not None else None
+        matches = []
+        for entry in self._index:
+            if key is not None and entry["key"] != key:
+                continue
+            stored = entry["parameters"]
+            if all(_matches(stored.get(name.lower()), value) for name, value in parameters.items()):
+                matches.append(entry["model"])
+        return matches
+
+    def read(self, model, fields=STORE_FIELDS):
+        """Spectra of one model.
+
+        Parameters
+        ----------
+        model : int
+            Model number.
+        fields : tuple of str, optional
+            Spectra to read, by default all stored ones
+
+        Returns
+        -------
+        dict
+            Spectra by field name, as Quantities.
+        """
+        if not 0 <= model < len(self._index):
+            raise IndexError(f"Model {model} not in store of {len(self._index)} models")
+        shard, row = divmod(model, self.meta["shard_size"])
+        return {field: np.array(self._load_shard(shard, field)[row]) * self.units for field in fields}
+
+    def iter_models(self, fields=STORE_FIELDS, shard=None):
+        """Iterate over the stored models, loading one shard at a time.
+
+        Parameters
+        ----------
+        fields : tuple of str, optional
+            Spectra to read, by default all stored ones
+        shard : int, optional
+            Only iterate over the models of this shard (models shard * shard_size onwards), by default all
+
+        Yields
+        ------
+        dict
+            Index table entry of the model.
+        dict
+            Spectra by field name, as Quantities.
+        """
+        shard_size = self.meta["shard_size"]
+        starts = range(0, len(self._index), shard_size)
+        for start in starts if shard is None else starts[shard : shard + 1]:
+            arrays = {field: self._load_shard(start // shard_size, field) for field in fields}
+            for entry in self._index[start : start + shard_size]:
+                row = entry["model"] - start
+                yield entry, {field: np.array(arrays[field][row]) * self.units for field in fields}
+
+    def _shard_path(self, shard, field):
+        return os.path.join(self.directory, f"{field}_{shard:05d}.npy")
+
+    def _open_shard(self, shard):
+        """Memory-mapped arrays of the shard being filled, created if needed."""
+        if self._shard is None or self._shard[0] != shard:
+            self.close()
+            shape = (self.meta["shard_size"], self.meta["n_lam"])
+            arrays = {}
+            for field in STORE_FIELDS:
+                path = self._shard_path(shard, field)
+                if os.path.isfile(path):
+                    arrays[field] = np.load(path, mmap_mode="r+")
+                else:
+                    arrays[field] = np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=shape)
+            self._shard = (shard, arrays)
+        return self._shard[1]
+
+    def _close_shard(self):
+        """Finish a full shard, compressing it if the store is compressed."""
+        shard, arrays = self._shard
+        self.close()
+        if self.meta["compression"] == "ZLIB":
+            for field, array in arrays.items():
+                path = self._shard_path(shard, field)
+                with open(path + ".z", "wb") as file:
+                    file.write(_shuffle_compress(np.asarray(array)))
+                os.remove(path)
+
+    def _load_shard(self, shard, field):
+        """Shard of one field: memory-mapped if plain, decompressed if compressed."""
+        path = self._shard_path(shard, field)
+        if os.path.isfile(path):
+            return np.load(path, mmap_mode="r")
+        with open(path + ".z", "rb") as file:
+            return _unshuffle_decompress(file.read(), (self.meta["shard_size"], self.meta["n_lam"]))
+
+
+def _shuffle_compress(array):
+    """Compress a float64 array after grouping the bytes of equal significance, which zlib compresses far better."""
+    shuffled = np.ascontiguousarray(array, dtype=np.float64).view(np.uint8).reshape(-1, 8).T
+    return zlib.compress(shuffled.tobytes(), COMPRESSION_LEVEL)
+
+
+def _unshuffle_decompress(data, shape):
+    """Inverse of _shuffle_compress."""
+    shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(8, -1)
+    return np.ascontiguousarray(shuffled.T).view(np.float64).reshape(shape)
+
+
+def _matches(stored, value):
+    """Whether a parameter value from an index table entry (numbers in config units) equals a requested value."""
+    stored = stored[0] if isinstance(stored, list) else stored
+    try:
+        return stored is not None and bool(np.isclose(float(stored), float(value)))
+    except (TypeError, ValueError):
+        return str(stored) == str(value)
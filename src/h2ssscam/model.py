@@ -0,0 +1,628 @@
+"""
+Model pipeline: load line data, compute populations, source function,
+absorption rates and the emergent H₂ fluorescence spectrum.
+"""
+import functools
+import logging
+import os
+import astropy.constants as c
+import astropy.units as u
+import numpy as np
+from scipy import sparse
+from h2ssscam.BaseCalc import BaseCalc
+from h2ssscam.Constants import Constants
+from h2ssscam.data_loader import load_data
+from h2ssscam.result_cache import ResultCache, result_key
+
+# Wavelength grid limits in angstroms
+LAM0, LAMEND = 912, 1800
+
+# Maximum number of absorption passes used to refine automatic line selection
+MAX_SELECTION_PASSES = 4
+# optical depth, as a fraction of FLUX_TOLERANCE, below which the profiles of absorption-only lines are truncated
+ABSORBER_TAU_FLOOR = 1e-3
+# outputs of run_model with DISSOCIATION = ON
+DISSOCIATION_ARRAYS = ("dissociation_per_level", "dissociation_rate")
+# unit of the dissociation outputs, independent of UNIT
+DISSOCIATION_UNIT = u.ph * u.cm**-2 * u.s**-1 * u.sr**-1
+# projected size in bytes of the dense line-by-wavelength absorption matrices above which run_model warns
+DENSE_MEMORY_WARNING = 2e9
+# SPEC_GROUPS settings and the H2 line-list column that groups the lines ('PUMP' groups by pumping transition)
+SPEC_GROUPINGS = {"NONE": None, "BAND": "band", "VU": "vu", "PUMP": None}
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=8)
+def wavelength_grid(dlam, lam0=LAM0, lamend=LAMEND):
+    """Build an evenly sampled wavelength grid.
+
+    Grids are cached and shared between calls, so the returned array is read-only.
+
+    Parameters
+    ----------
+    dlam : float
+        Wavelength sampling in angstroms.
+    lam0 : float, optional
+        Start of the grid in angstroms, by default LAM0
+    lamend : float, optional
+        End of the grid in angstroms, by default LAMEND
+
+    Returns
+    -------
+    astropy.units.Quantity
+        Wavelength grid in Å.
+    """
+    lam = np.linspace(int(lam0), int(lamend), int((lamend - lam0) / dlam)) * u.AA
+    lam.flags.writeable = False
+    return lam
+
+
+def load_lines(constant):
+    """Load the H2 and HI line lists with units attached.
+
+    Parameters
+    ----------
+    constant : Constants
+        Model parameters; H2 lines are restricted to v <= VMAX, J <= JMAX.
+
+    Returns
+    -------
+    dict
+        {"h2": {...}, "hi": {...}} with one array per line quantity, including the H2 oscillator strengths.
+    """
+    # Abgrall et al. (1993) fluorescence line list
+    s = load_data("h2fluor_data_Abgrall+1993")
+    h2 = {
+        "Atot": s["Atot"] * u.s**-1,
+        "Auldiss": s["Auldiss"] * u.s**-1,
+        "Aul": s["Aul"] * u.s**-1,
+        "lamlu": s["lamlu"] * u.AA,
+        "band": s["band"],
+        "vu": s["vu"],
+        "ju": s["ju"],
+        "vl": s["vl"],
+        "jl": s["jl"],
+    }
+
+    # Filter by v <= VMAX, J <= JMAX
+    mask_h2 = (h2["vl"] <= constant.VMAX) & (h2["jl"] <= constant.JMAX)
+    h2 = {key: value[mask_h2] for key, value in h2.items()}
+
+    # H2 oscillator strengths
+    h2["flu"] = BaseCalc(constant).calc_flu(h2["ju"], h2["jl"], h2["lamlu"], h2["Aul"])  # Eq. 2
+
+    # NIST Atomic Spectral Database for HI
+    s = load_data("hi_data_NIST")
+    hi = {
+        "lamlu": s["lamlu"] * u.AA,
+        "jl": s["jl"],
+        "ju": s["ju"],
+        "Aul": s["Aul"] * u.s**-1,
+        "flu": s["flu"],
+    }
+    return {"h2": h2, "hi": hi}
+
+
+def restrict_lines(lines, constant):
+    """Restrict line lists loaded for larger VMAX or JMAX to those of constant.
+
+    Parameters
+    ----------
+    lines : dict
+        Line lists from load_lines.
+    constant : Constants
+        Model parameters.
+
+    Returns
+    -------
+    dict
+        lines itself if nothing has to be removed, otherwise a filtered copy.
+    """
+    h2 = lines["h2"]
+    mask_h2 = (h2["vl"] <= constant.VMAX) & (h2["jl"] <= constant.JMAX)
+    if mask_h2.all():
+        return lines
+    return {"h2": {key: value[mask_h2] for key, value in h2.items()}, "hi": lines["hi"]}
+
+
+def save_result(constant, result, output_dir="."):
+    """Save an emergent spectrum from run_model as a compressed npz file.
+
+    Parameters
+    ----------
+    constant : Constants
+        Model parameters, used to name the file. The name ends in the first characters of the result key, so
+        configs that round to the same name do not overwrite each other.
+    result : dict
+        Output of run_model.
+    output_dir : str, optional
+        Directory for the file, by default the current directory
+
+    Returns
+    -------
+    str
+        Path of the saved file.
+    """
+    units = result["units"]
+    path = os.path.join(
+        output_dir,
+        f"h2-fluor-model_R={constant.RESOLVING_POWER}_TH2={int(constant.TH2.value)}_NH2={int(np.log10(constant.NH2_TOT.value))}_THI={int(constant.THI.value)}_NHI={int(np.log10(constant.NHI_TOT.value))}_{result_key(constant)[:8]}.npz",
+    )
+    np.savez_compressed(
+        path,
+        lam_shifted=result["lam_shifted"].value,
+        spec=result["spec"].to(units).value,
+        spec_tot=result["spec_tot"].to(units).value,
+        spec_components=result["spec_components"].to(units).value,
+        **({"spec_groups": result["spec_groups"].to(units).value} if "spec_groups" in result else {}),
+        **{key: result[key].to_value(DISSOCIATION_UNIT) for key in DISSOCIATION_ARRAYS if key in result},
+        **({"spec_group_keys": result["spec_group_keys"]} if "spec_group_keys" in result else {}),
+    )
+    return path
+
+
+def dissociation_rates(constant, h2, abs_rate_per_trans):
+    """Photodissociation rates of H2 from the absorption rates of the pumping transitions.
+
+    Each absorption leaves the molecule in an upper level that dissociates with probability Auldiss / Atot, so no
+    radiative transfer beyond the absorption rates is needed. Absorbed energy (UNIT = 'ERGS') is converted to
+    photons at the wavelength of each transition, so the rates are photon counts in either unit mode.
+
+    Parameters
+    ----------
+    constant : Constants
+        Model parameters (VMAX, JMAX).
+    h2 : dict
+        H2 line list from load_lines.
+    abs_rate_per_trans : astropy.units.Quantity
+        Absorption rate of every H2 transition as in run_model, shape (n_components, n_h2_lines): integrated over
+        wavelength in Å, but labelled with the spectral units of the result.
+
+    Returns
+    -------
+    astropy.units.Quantity
+        Dissociation rate through each transition in DISSOCIATION_UNIT, shape (n_components, n_h2_lines).
+    astropy.units.Quantity
+        Dissociation rate out of each lower level (v, J) in DISSOCIATION_UNIT, shape
+        (n_components, VMAX + 1, JMAX + 1).
+    """
+    abs_rate = abs_rate_per_trans * u.AA  # restore the Å of the wavelength integral
+    if not abs_rate.unit.is_equivalent(DISSOCIATION_UNIT):
+        abs_rate = abs_rate / (c.h * c.c / h2["lamlu"]) * u.ph
+    p_diss = (h2["Auldiss"] / h2["Atot"]).decompose().value
+    per_trans = abs_rate.to(DISSOCIATION_UNIT) * p_diss
+    per_level = np.zeros((len(per_trans), int(constant.VMAX) + 1, int(constant.JMAX) + 1)) * per_trans.unit
+    for k in range(len(per_trans)):
+        np.add.at(per_level.value, (k, h2["vl"], h2["jl"]), per_trans[k].value)
+    return per_trans, per_level
+
+
+def emission_lines(constant, h2, sel_levels, abs_rate_per_trans, line_strength_cutoff=None):
+    """Assemble the emission branches fed by the pumped transitions.
+
+    Parameters
+    ----------
+    constant : Constants
+        Model parameters (BP_MIN, BP_MAX).
+    h2 : dict
+        H2 line list from load_lines.
+    sel_levels : array
+        Indices into h2 of the pumped (absorbing) transitions.
+    abs_rate_per_trans : astropy.units.Quantity
+        Absorption rate of each pumped transition.
+    line_strength_cutoff : float, optional
+        Minimum A_ul/A_tot of an emission branch, by default LINE_STRENGTH_CUTOFF
+
+    Returns
+    -------
+    array
+        Indices into h2 of the emission lines.
+    array
+        Index into sel_levels of the transition pumping each emission line.
+    astropy.units.Quantity
+        Flux per emission line.
+    """
+    if line_strength_cutoff is None:
+        line_strength_cutoff = constant.LINE_STRENGTH_CUTOFF
+    Atot, Aul, lamlu, band, vu, ju = h2["Atot"], h2["Aul"], h2["lamlu"], h2["band"], h2["vu"], h2["ju"]
+    emit_idx, pump_idx = [], []
+    for ui, level in enumerate(sel_levels):
+        idx_u = np.where((vu == vu[level]) & (ju == ju[level]) & (band == band[level]))[0]
+        for idx in idx_u:
+            if np.any(
+                (Aul[idx] / Atot[idx] < line_strength_cutoff)
+                | (lamlu[idx] < constant.BP_MIN)
+                | (lamlu[idx] > constant.BP_MAX)
+            ):
+                continue
+            emit_idx.append(idx)
+            pump_idx.append(ui)
+
+    emit_idx = np.array(emit_idx, dtype=int)
+    pump_idx = np.array(pump_idx, dtype=int)
+    flux_per_trans = abs_rate_per_trans[pump_idx] * (Aul[emit_idx] / Atot[emit_idx]).decompose().value
+    return emit_idx, pump_idx, flux_per_trans
+
+
+def run_model(constant: Constants, lines=None, basecalc: BaseCalc | None = None):
+    """Compute the emergent H2 fluorescence spectrum for every velocity component in constant.COMPONENTS.
+
+    Components with the same Doppler width share their cross-sections and emission profiles: these are computed
+    once in the rest frame and shifted onto the grid for each component's velocity. Velocities are taken
+    relative to the first component, whose frame is also the frame of the HI absorber; the returned grid is
+    shifted by the first component's velocity.
+
+    Parameters
+    ----------
+    constant : Constants
+        Model parameters.
+    lines : dict, optional
+        Line lists from load_lines, loaded if not given.
+    basecalc : BaseCalc, optional
+        Calculator to use, a new one is created if not given.
+
+    Returns
+    -------
+    dict
+        lam_shifted, spec, spec_tot and spec_components (one emission spectrum per component, summing to spec),
+        plus the source grid lam and source spectrum, and per component and H2 transition the absorption rate
+        (abs_rate_per_trans) and emitted flux (flux_per_line), both of shape (n_components, n_h2_lines). With
+        DISSOCIATION = ON also the photodissociation rates per lower level (dissociation_per_level, shape
+        (n_components, VMAX + 1, JMAX + 1)) and per component (dissociation_rate), in DISSOCIATION_UNIT. With SPEC_GROUPS set also the
+        emission spectrum per group (spec_groups, shape (n_groups, len(lam_shifted)), summing to spec) and the group
+        labels (spec_group_keys: band names, upper vibrational levels, or indices into the H2 line list of the
+        pumping transitions).
+    """
+    basecalc = BaseCalc(constant) if basecalc is None else basecalc
+    lines = load_lines(constant) if lines is None else lines
+    h2, hi = lines["h2"], lines["hi"]
+    components = constant.COMPONENTS
+    units = constant.CU_UNIT if constant.UNIT == "CU" else constant.ERG_UNIT
+
+    # Compute Doppler widths
+    basecalc.dv_phys
+    basecalc.dv_tot
+    v_ref = components[0].DOPPLER_SHIFT
+    dv_phys = [basecalc._calc_dv(T=comp.TH2, b=comp.VELOCITY_DISPERSION) for comp in components]
+    dv_tot = [basecalc._calc_dv(instr=True, T=comp.TH2, b=comp.VELOCITY_DISPERSION) for comp in components]
+
+    # Wavelength grids: absorption lines span the whole grid, emission lines only the bandpass
+    dlam = _grid_step(constant.SOURCE_DLAM, basecalc, min(dv_phys, key=lambda dv: dv.value), LAM0 * u.AA)
+    dlam_highres = _grid_step(constant.DLAM, basecalc, min(dv_tot, key=lambda dv: dv.value), constant.BP_MIN)
+    lam = wavelength_grid(dlam)
+    lam_highres = wavelength_grid(dlam_highres)
+    logger.info(
+        f"Source grid: dlam = {dlam:.4g} Å ({len(lam)} points); "
+        f"emission grid: dlam = {dlam_highres:.4g} Å ({len(lam_highres)} points)"
+    )
+
+    # Incident UV background
+    if constant.INC_SOURCE == "BLACKBODY":
+        uv_inc = basecalc.blackbody(lam, constant.THI, unit=units)
+    else:
+        uv_inc = basecalc.uv_continuum(lam, unit=units)  # empirical cont.
+
+    # H2 oscillator strengths and per-component level populations
+    flu = h2["flu"]
+    nvj_lines = [basecalc.calc_nvj(comp.NH2_TOT, comp.TH2)[h2["vl"], h2["jl"]] for comp in components]  # Eq. 8
+
+    # Pumping transitions: fixed per-level cutoff, or the fewest lines whose optically thin in-band yield
+    # leaves at most half of FLUX_TOLERANCE unaccounted for
+    auto = constant.LINE_SELECTION == "AUTO"
+    line_strength_cutoff = 0 if auto else constant.LINE_STRENGTH_CUTOFF
+    inband = _inband_fraction(constant, h2)
+    thin = [_thin_abs_rate(lam, uv_inc, h2, flu, nvj, units) * inband for nvj in nvj_lines]
+    order = [np.argsort(est)[::-1] for est in thin]
+    if auto:
+        tol_abs = constant.FLUX_TOLERANCE / 2
+        sel_levels = [np.sort(o[: _n_keep(est[o], tol_abs * est.sum())]) for est, o in zip(thin, order)]
+        # lines that pump little in-band flux but still imprint their absorption on the continuum
+        tau_min = ABSORBER_TAU_FLOOR * constant.FLUX_TOLERANCE
+        absorbers, absorber_tau = [], []
+        for dv, nvj in zip(dv_phys, nvj_lines):
+            peak_tau = basecalc.peak_tau(h2["lamlu"], h2["Atot"], dv, flu, nvj)
+            strong = np.flatnonzero(peak_tau >= constant.FLUX_TOLERANCE)
+            lamlu, Atot = h2["lamlu"][strong], h2["Atot"][strong]
+            absorbers.append(strong)
+            absorber_tau.append(basecalc.calc_line_tau(lam, lamlu, Atot, dv, flu[strong], nvj[strong], tau_min))
+    else:
+        sel_levels = [np.where(nvj > constant.NH2_CUTOFF)[0] for nvj in nvj_lines]
+
+    # HI calculations
+    NHI = basecalc.boltzmann(constant.NHI_TOT, hi["ju"], hi["jl"], hi["lamlu"], constant.THI)
+
+    # Dense cross-sections, optical depths and absorption rates each hold one row per line on the source grid
+    if not constant.SPARSE_THRESHOLD:
+        n_rows = len(hi["lamlu"]) + sum(len(sel) for sel in sel_levels)
+        nbytes = 3 * n_rows * len(lam) * np.dtype(basecalc.dtype).itemsize
+        logger.info(f"Dense absorption matrices: {n_rows} lines x {len(lam)} points, about {nbytes / 1e9:.2f} GB")
+        if nbytes > DENSE_MEMORY_WARNING:
+            logger.warning(
+                f"Dense absorption matrices need about {nbytes / 1e9:.1f} GB; set SPARSE_THRESHOLD (e.g. 1e-6) or a "
+                f"coarser SOURCE_DLAM to reduce it"
+            )
+
+    for _ in range(MAX_SELECTION_PASSES):
+        basecalc._siglu = basecalc._tau = basecalc._tau_tot = None
+
+        # Absorption cross-sections: one rest-frame evaluation per distinct Doppler width, shifted per component
+        threshold = constant.SPARSE_THRESHOLD
+        siglu_hi = basecalc._calc_siglu(lam, hi["lamlu"], hi["Aul"], basecalc.dv_phys, hi["flu"], threshold, NHI)
+        siglu_h2 = {}
+        for group in _group_by_dv(dv_phys):
+            union = np.unique(np.concatenate([sel_levels[k] for k in group]))
+            nvj_max = u.Quantity([nvj_lines[k][union] for k in group]).max(axis=0)
+            siglu_group = basecalc._calc_siglu(
+                lam, h2["lamlu"][union], h2["Atot"][union], dv_phys[group[0]], flu[union], threshold, nvj_max
+            )
+            for k in group:
+                rows = siglu_group[np.searchsorted(union, sel_levels[k])]
+                siglu_h2[k] = basecalc._dopp_resample(lam, rows, components[k].DOPPLER_SHIFT - v_ref)
+        basecalc._siglu = _vstack([siglu_hi] + [siglu_h2[k] for k in range(len(components))])
+
+        # Optical depths
+        hih2_N = np.concatenate([NHI] + [nvj[sel] for nvj, sel in zip(nvj_lines, sel_levels)])
+        tau = basecalc.tau(hih2_N)
+        tau_tot = basecalc.tau_tot
+        if auto:
+            # absorption-only lines enter the total optical depth without cross-section rows of their own
+            for k, comp in enumerate(components):
+                extra = np.flatnonzero(~np.isin(absorbers[k], sel_levels[k]))
+                tau_extra = np.asarray(absorber_tau[k][extra].sum(axis=0, dtype=np.float64))
+                tau_tot = tau_tot + basecalc._dopp_resample(lam, tau_extra, comp.DOPPLER_SHIFT - v_ref)
+            basecalc._tau_tot = tau_tot
+
+        # Absorption rates for H2 only
+        tau_h2 = tau[len(hi["lamlu"]) :, :]
+        abs_rate = basecalc.calc_abs_rate(uv_inc, tau_h2, tau_tot, unit=units) * dlam  # Eq. 12–13
+        if sparse.issparse(abs_rate):
+            abs_rate_per_trans = abs_rate.sum(axis=1, dtype=np.float64) * units
+        else:
+            abs_rate_per_trans = np.sum(abs_rate, axis=1, dtype=np.float64)
+        offsets = np.cumsum([0] + [len(sel) for sel in sel_levels])
+        abs_rates = [abs_rate_per_trans[offsets[k] : offsets[k + 1]] for k in range(len(components))]
+
+        # In-band flux actually pumped by the kept transitions vs. the thin-limit bound on what was left out
+        kept = [np.sum(rate.to_value(units) * inband[sel]) for rate, sel in zip(abs_rates, sel_levels)]
+        dropped = [est.sum() - est[sel].sum() for est, sel in zip(thin, sel_levels)]
+        if not auto:
+            break
+        n_keep = [
+            _n_keep(est[o], tol_abs * (k_flux + d_flux)) for est, o, k_flux, d_flux in zip(thin, order, kept, dropped)
+        ]
+        if all(n <= len(sel) for n, sel in zip(n_keep, sel_levels)):
+            break
+        sel_levels = [np.sort(o[: max(n, len(sel))]) for o, n, sel in zip(order, n_keep, sel_levels)]
+
+    # Attenuated source
+    source = uv_inc * np.exp(-tau_tot)
+
+    abs_rate_lines = np.zeros((len(components), len(h2["lamlu"]))) * units
+    for k, sel in enumerate(sel_levels):
+        abs_rate_lines[k, sel] = abs_rates[k]
+    if auto:
+        # absorption rates of the absorption-only lines, from the optical depths already computed for tau_tot
+        for k, comp in enumerate(components):
+            extra = np.flatnonzero(~np.isin(absorbers[k], sel_levels[k]))
+            tau_extra = basecalc._dopp_resample(lam, absorber_tau[k][extra], comp.DOPPLER_SHIFT - v_ref)
+            rate = basecalc.calc_abs_rate(uv_inc, sparse.csr_array(tau_extra), tau_tot, unit=units) * dlam
+            abs_rate_lines[k, absorbers[k][extra]] = rate.sum(axis=1, dtype=np.float64) * units
+
+    # Emission lines fed by each component's pumped transitions, pruned to the remaining flux budget
+    emission, line_selection = [], []
+    flux_lines = np.zeros((len(components), len(h2["lamlu"]))) * units
+    for k in range(len(components)):
+        emit_idx, pump_idx, flux_per_trans = emission_lines(
+            constant, h2, sel_levels[k], abs_rates[k], line_strength_cutoff
+        )
+        total = kept[k] + dropped[k]
+        if auto:
+            budget = constant.FLUX_TOLERANCE * total - dropped[k]
+            flux = flux_per_trans.to_value(units)
+            order_em = np.argsort(flux)
+            keep = np.sort(order_em[np.cumsum(flux[order_em]) > budget])
+            emit_idx, pump_idx, flux_per_trans = emit_idx[keep], pump_idx[keep], flux_per_trans[keep]
+        emission.append((emit_idx, pump_idx, flux_per_trans))
+        np.add.at(flux_lines.value, (k, emit_idx), flux_per_trans.to_value(units))
+
+        discarded = 1 - flux_per_trans.to_value(units).sum() / total if total > 0 else 0.0
+        line_selection.append(
+            {"pumping_lines": len(sel_levels[k]), "emission_lines": len(emit_idx), "flux_discarded": discarded}
+        )
+        logger.info(
+            f"Component {k + 1}: {len(sel_levels[k])} pumping lines, {len(emit_idx)} emission lines, "
+            f"at most {100 * discarded:.3g}% of the in-band flux discarded"
+        )
+
+    source_highres = np.interp(lam_highres, lam, source)
+
+    # Breakdown of the emission spectrum: labels of the groups that emit, and the group of every emission line unless
+    # lines are grouped by their pumping transitions, which several lines share
+    grouping = constant.SPEC_GROUPS.upper()
+    if grouping not in SPEC_GROUPINGS:
+        raise ValueError(f"Unknown SPEC_GROUPS {constant.SPEC_GROUPS}, use one of {', '.join(SPEC_GROUPINGS)}")
+    if grouping == "PUMP":
+        group_keys = np.unique(np.concatenate([sel_levels[k][pump_idx] for k, (_, pump_idx, _) in enumerate(emission)]))
+    elif grouping != "NONE":
+        emitting = np.unique(np.concatenate([emit_idx for emit_idx, _, _ in emission]))
+        group_keys, groups = np.unique(h2[SPEC_GROUPINGS[grouping]][emitting], return_inverse=True)
+        line_group = np.zeros(len(h2["lamlu"]), dtype=int)
+        line_group[emitting] = groups
+    if grouping != "NONE":
+        spec_groups = np.zeros((len(group_keys), len(lam_highres))) * units
+
+    # Emergent spectrum: one profile evaluation per distinct Doppler width, shared by the components in the group
+    spec_components = np.zeros((len(components), len(lam_highres))) * units
+    for group in _group_by_dv(dv_tot):
+        union = np.unique(np.concatenate([emission[k][0] for k in group]))
+        if not len(union):  # nothing above the cutoffs: these components do not emit
+            continue
+        flux = np.zeros((len(group), len(group_keys), len(union)) if grouping == "PUMP" else (len(group), len(union)))
+        flux = flux * units
+        for row, k in enumerate(group):
+            emit_idx, pump_idx, flux_per_trans = emission[k]
+            index = (row, np.searchsorted(union, emit_idx))
+            if grouping == "PUMP":
+                index = (row, np.searchsorted(group_keys, sel_levels[k][pump_idx]), index[1])
+            np.add.at(flux.value, index, flux_per_trans.to(units).value)
+        groups = line_group[union] if grouping in ("BAND", "VU") else None
+        _, spec_group, _ = basecalc.calc_spec(
+            lam_highres,
+            h2["lamlu"][union],
+            h2["Atot"][union],
+            dv_tot[group[0]],
+            flux,
+            source_highres,
+            units,
+            threshold=constant.SPARSE_THRESHOLD,
+            tile_size=constant.TILE_SIZE,
+            groups=groups,
+            n_groups=len(group_keys) if groups is not None else None,
+        )
+        for row, k in enumerate(group):
+            spectra = basecalc._dopp_resample(lam_highres, spec_group[row], components[k].DOPPLER_SHIFT - v_ref)
+            if grouping != "NONE":
+                spec_groups += spectra
+                spectra = spectra.sum(axis=0)
+            spec_components[k] = spectra
+
+    spec = np.sum(spec_components, axis=0)
+    spec_tot = spec + source_highres
+    lam_shifted = basecalc._dopp_shift(lam_highres, v_ref)
+
+    result = {
+        "lam": lam,
+        "source": source,
+        "lam_shifted": lam_shifted,
+        "spec": spec,
+        "spec_tot": spec_tot,
+        "spec_components": spec_components,
+        "units": units,
+        "line_selection": line_selection,
+        "abs_rate_per_trans": abs_rate_lines,
+        "flux_per_line": flux_lines,
+    }
+    if grouping != "NONE":
+        if group_keys.dtype.kind == "S":
+            group_keys = np.char.decode(group_keys)
+        elif group_keys.dtype == object:
+            group_keys = np.array([key.decode() if isinstance(key, bytes) else str(key) for key in group_keys])
+        result.update(spec_groups=spec_groups, spec_group_keys=group_keys)
+    if constant.DISSOCIATION == "ON":
+        _, result["dissociation_per_level"] = dissociation_rates(constant, h2, abs_rate_lines)
+        result["dissociation_rate"] = result["dissociation_per_level"].sum(axis=(1, 2))
+        logger.info(f"H2 photodissociation rate: {result['dissociation_rate'].sum():.4g}")
+    return result
+
+
+def velocity_sweep(constant, result, velocities, lam_out=None, fields=("spec", "spec_tot")):
+    """Spectra of a model for a range of DOPPLER_SHIFT values, from one synthesis, on one common wavelength grid.
+
+    Moving the first component moves the whole model: the other components keep their velocities relative to it
+    and the HI absorber stays in its frame, so only the output grid shifts. The spectra of result are therefore
+    shifted and rebinned (conserving flux) instead of being synthesized again for every velocity.
+
+    Parameters
+    ----------
+    constant : Constants
+        Model parameters of result.
+    result : dict
+        Output of run_model.
+    velocities : astropy.units.Quantity
+        DOPPLER_SHIFT values of the first component.
+    lam_out : astropy.units.Quantity, optional
+        Common output grid, by default the grid of result (lam_shifted).
+    fields : tuple of str, optional
+        Spectra to shift, by default ('spec', 'spec_tot')
+
+    Returns
+    -------
+    astropy.units.Quantity
+        The output grid.
+    dict
+        Spectra by field name, shape (len(velocities), len(lam_out)); each is the spectrum that run_model gives at
+        that velocity, rebinned onto lam_out.
+    """
+    basecalc = BaseCalc(constant)
+    lam_out = result["lam_shifted"] if lam_out is None else lam_out
+    # velocity relative to the run, exact for the (1 + v / c) shifts of run_model
+    relative = ((1 + velocities / c.c) / (1 + constant.COMPONENTS[0].DOPPLER_SHIFT / c.c) - 1) * c.c
+    spectra = {
+        field: basecalc.resample_spectra(result["lam_shifted"], result[field][None], relative, lam_out)
+        for field in fields
+    }
+    return lam_out, spectra
+
+
+def run_cached(constant, lines=None, basecalc=None):
+    """run_model, served from the result cache in RESULT_CACHE_DIR when one is configured.
+
+    Parameters
+    ----------
+    constant : Constants
+        Model parameters.
+    lines : dict, optional
+        Line lists from load_lines, loaded if needed and not given.
+    basecalc : BaseCalc, optional
+        Calculator to use, a new one is created if not given.
+
+    Returns
+    -------
+    dict
+        Output of run_model.
+    """
+    if not constant.RESULT_CACHE_DIR:
+        return run_model(constant, lines, basecalc)
+    cache = ResultCache(constant.RESULT_CACHE_DIR, int(constant.RESULT_CACHE_MAX_MB * 1e6))
+    result = cache.get(constant)
+    if result is None:
+        result = run_model(constant, lines, basecalc)
+        cache.put(constant, result)
+    else:
+        logger.info(f"Loaded stored result {result_key(constant)[:16]} from {constant.RESULT_CACHE_DIR}")
+    return result
+
+
+def _grid_step(dlam, basecalc, dv, lam):
+    """Wavelength spacing in Å: dlam itself, or for 'AUTO' SAMPLES_PER_FWHM samples across a profile of width dv at lam."""
+    if isinstance(dlam, str):
+        dlam = basecalc.calc_dlam(dv, lam, basecalc.constant.SAMPLES_PER_FWHM)
+    return dlam.to_value(u.AA)
+
+
+def _vstack(blocks):
+    """Stack line-by-wavelength matrices, sparse or dense."""
+    if sparse.issparse(blocks[0]):
+        return sparse.vstack(blocks, format="csr")
+    return np.concatenate(blocks)
+
+
+def _group_by_dv(dvs):
+    """Group component indices by identical Doppler width, in order of first appearance."""
+    groups = {}
+    for k, dv in enumerate(dvs):
+        groups.setdefault(dv.to_value(u.km / u.s), []).append(k)
+    return list(groups.values())
+
+
+def _inband_fraction(constant, h2):
+    """Fraction of decays from each line's upper level that emit in [BP_MIN, BP_MAX]."""
+    ratio = (h2["Aul"] / h2["Atot"]).decompose().value
+    in_band = (h2["lamlu"] >= constant.BP_MIN) & (h2["lamlu"] <= constant.BP_MAX)
+    band = np.unique(h2["band"], return_inverse=True)[1]
+    _, level = np.unique(np.stack([band, h2["vu"], h2["ju"]]), axis=1, return_inverse=True)
+    return np.bincount(level, weights=ratio * in_band)[level]
+
+
+def _thin_abs_rate(lam, I0, h2, flu, nvj, units):
+    """Optically thin absorption rate of each H2 transition, an upper bound on the rate from calc_abs_rate."""
+    W = (np.pi * c.e.esu**2 / (c.m_e * c.c**2) * nvj * flu * h2["lamlu"] ** 2).to_value(u.AA)
+    return np.interp(h2["lamlu"].to_value(u.AA), lam.to_value(u.AA), I0.to_value(units)) * W
+
+
+def _n_keep(sorted_weights, budget):
+    """Smallest n such that the weights after the first n (sorted in descending order) sum to at most budget."""
+    tails = sorted_weights.sum() - np.concatenate([[0], np.cumsum(sorted_weights)])
+    tails[-1] = 0
+    return int(np.argmax(tails <= budget))
@@ -1,3 +1,30 @@
+"""
+Plotting of model spectra, with a fast path for long spectra and batch export of saved models to PNG files.
+
+Usage: python -m h2ssscam.plotting_funcs MODEL [MODEL ...] [--output DIRECTORY] [--workers N] [--field spec]
+       (MODEL is an npz file from save_result or a grid store directory)
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+import numpy as np
+
+
+def _headless():
+    """Whether no display is available and no backend was chosen through MPLBACKEND."""
+    if os.environ.get("MPLBACKEND"):
+        return False
+    if sys.platform.startswith("linux"):
+        return not (os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+    return False
+
+
+# render off-screen without a display, so that sweeps can produce figures on compute nodes
+if _headless():
+    matplotlib.use("Agg")
+
 import matplotlib.pyplot as plt
 import astropy.units as u
 
@@ -11,7 +38,8 @@ def plot_spectrum(wavelengths,
                   units = None,
                   ylabel=None,
                   title=r"Spectrum",
-                  show=False):
+                  show=False,
+                  decimate=False):
     """Plots intensity over wavelength.
 
     Parameters
@@ -36,6 +64,14 @@ def plot_spectrum(wavelengths,
         Title of the Plot, by default r"Spectrum"
     show : bool, optional
         Option to display plot, by default False
+    decimate : bool, optional
+        Option to reduce the spectrum to a min/max envelope at the horizontal resolution of the figure before
+        plotting, which renders long spectra much faster and keeps narrow line peaks, by default False
+
+    Returns
+    -------
+    matplotlib.figure.Figure
+        The new figure.
 
     Raises
     ------
@@ -43,7 +79,9 @@ def plot_spectrum(wavelengths,
         
     """    
 
-    plt.figure()
+    fig = plt.figure()
+    if decimate:
+        wavelengths, intensity = decimate_minmax(wavelengths, intensity, int(fig.get_figwidth() * fig.dpi), xmin, xmax)
     plt.plot(wavelengths, intensity, lw=0.5)
     plt.title(title)
     plt.xlabel(r"Wavelength (\AA)")
@@ -59,5 +97,140 @@ def plot_spectrum(wavelengths,
     plt.xlim([xmin, xmax])
     plt.ylim([ymin, ymax])
     if show: plt.show()
+    return fig
+
+
+def decimate_minmax(wavelengths, intensity, n_bins, xmin=None, xmax=None):
+    """Reduce a spectrum to the minimum and maximum of each of n_bins bins, in wavelength order.
+
+    Drawn at a horizontal resolution of n_bins pixels, the envelope looks the same as the full spectrum: every
+    line peak survives, however narrow.
+
+    Parameters
+    ----------
+    wavelengths : array
+        Increasing wavelength grid.
+    intensity : array
+        Intensity on the grid.
+    n_bins : int
+        Number of bins, e.g. the width of the plot in pixels.
+    xmin : float, optional
+        Drop points below this wavelength first, by default None
+    xmax : float, optional
+        Drop points above this wavelength first, by default None
+
+    Returns
+    -------
+    array
+        Wavelengths of the kept points, two per bin.
+    array
+        Intensity of the kept points.
+    """
+    grid = np.asarray(getattr(wavelengths, "value", wavelengths))
+    start = 0 if xmin is None else max(np.searchsorted(grid, xmin) - 1, 0)
+    stop = len(grid) if xmax is None else min(np.searchsorted(grid, xmax, side="right") + 1, len(grid))
+    wavelengths, intensity = wavelengths[start:stop], intensity[start:stop]
+    n = len(wavelengths)
+    if n <= 2 * n_bins:
+        return wavelengths, intensity
+
+    # equal-count bins match pixels on the equally spaced model grids; the padding repeats the last point
+    values = np.asarray(getattr(intensity, "value", intensity))
+    size = -(-n // n_bins)
+    padded = np.concatenate([values, np.full(size * n_bins - n, values[-1])]).reshape(n_bins, size)
+    base = np.arange(n_bins) * size
+    lows, highs = base + padded.argmin(axis=1), base + padded.argmax(axis=1)
+    idx = np.minimum(np.column_stack([np.minimum(lows, highs), np.maximum(lows, highs)]).ravel(), n - 1)
+    return wavelengths[idx], intensity[idx]
+
+
+def export_pngs(models, output_dir=".", n_workers=None, field="spec", **plot_kwargs):
+    """Render saved models to PNG files in parallel worker processes, with the decimated plotting path.
+
+    Parameters
+    ----------
+    models : list of str
+        npz files from save_result and grid store directories, of which every model is rendered.
+    output_dir : str, optional
+        Directory for the PNG files, by default the current directory
+    n_workers : int, optional
+        Number of worker processes, by default os.cpu_count()
+    field : str, optional
+        Spectrum to plot, e.g. 'spec' or 'spec_tot', by default 'spec'
+    **plot_kwargs
+        Further arguments of plot_spectrum, e.g. xmin and xmax.
+
+    Returns
+    -------
+    list of str
+        Paths of the PNG files: the npz file name with .png, or model_NNNNN.png in a directory named after the
+        store.
+    """
+    from h2ssscam.grid_store import GridStore
+
+    # one task per npz file and per grid store shard, so that every compressed shard is decompressed once
+    tasks = []
+    for path in models:
+        if os.path.isdir(path):
+            store_dir = os.path.join(output_dir, os.path.basename(os.path.normpath(path)))
+            os.makedirs(store_dir, exist_ok=True)
+            store = GridStore(path)
+            shard_size = store.meta["shard_size"]
+            for shard in range(-(-len(store) // shard_size)):
+                tasks.append((_export_shard, path, shard, store_dir))
+        else:
+            png_path = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + ".png")
+            tasks.append((_export_npz, path, png_path))
+    os.makedirs(output_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=matplotlib.use, initargs=("Agg",)) as pool:
+        futures = [pool.submit(*task, field, plot_kwargs) for task in tasks]
+        return [png for future in futures for png in future.result()]
+
+
+def _export_npz(path, png_path, field, plot_kwargs):
+    """Render a model saved by save_result to png_path."""
+    with np.load(path) as data:
+        wavelengths, intensity = data["lam_shifted"], data[field]
+    return [_export_png(wavelengths, intensity, None, png_path, plot_kwargs)]
+
+
+def _export_shard(path, shard, store_dir, field, plot_kwargs):
+    """Render the models of one grid store shard to model_NNNNN.png files in store_dir."""
+    from h2ssscam.grid_store import GridStore
+
+    store = GridStore(path)
+    pngs = []
+    for entry, spectra in store.iter_models((field,), shard):
+        png_path = os.path.join(store_dir, f"model_{entry['model']:05d}.png")
+        pngs.append(_export_png(store.lam.value, spectra[field].value, store.units, png_path, plot_kwargs))
+    return pngs
+
+
+def _export_png(wavelengths, intensity, units, png_path, plot_kwargs):
+    """Render one spectrum to png_path with the decimated plotting path."""
+    plot_kwargs = {"title": os.path.splitext(os.path.basename(png_path))[0], "units": units, **plot_kwargs}
+    fig = plot_spectrum(wavelengths, intensity, decimate=True, **plot_kwargs)
+    fig.savefig(png_path)
+    plt.close(fig)
+    return png_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render saved h2ssscam models to PNG files.")
+    parser.add_argument("models", nargs="+", help="npz files from save_result or grid store directories")
+    parser.add_argument("--output", default=".", help="directory for the PNG files")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--field", default="spec", help="spectrum to plot, e.g. spec or spec_tot")
+    parser.add_argument("--xmin", type=float, default=None, help="minimum wavelength in angstroms")
+    parser.add_argument("--xmax", type=float, default=None, help="maximum wavelength in angstroms")
+    args = parser.parse_args()
+
+    pngs = export_pngs(args.models, args.output, args.workers, args.field, xmin=args.xmin, xmax=args.xmax)
+    print(f"{len(pngs)} figures saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
     
 
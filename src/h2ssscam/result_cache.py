@@ -0,0 +1,292 @@
+"""
+Content-hashed store of model results: a run with a configuration that was computed before is served from disk.
+
+Results are keyed by a hash of the full parameter set, the line-list data files and the package source code, so
+changing any of them invalidates the stored spectra.
+
+Usage: python -m h2ssscam.result_cache [directory] [--list] [--evict MB] [--clear]
+"""
+import argparse
+import functools
+import hashlib
+import importlib.resources
+import json
+import os
+import tempfile
+import time
+import astropy.units as u
+import numpy as np
+
+# Parameters that change how a result is computed but not the result itself
+NON_PHYSICAL_PARAMETERS = {"n_workers", "parallel_backend", "result_cache_dir", "result_cache_max_mb"}
+
+# Arrays of a result in angstroms; all other arrays are in the units of the result
+WAVELENGTH_ARRAYS = ("lam", "lam_shifted")
+
+
+def parameter_set(constant):
+    """Canonical, JSON-serializable parameter set of a Constants instance.
+
+    Values are taken from the attributes, so parameters changed after reading the config files are included, and
+    numbers are normalized so that e.g. 1e20 and 1.0E+20 give the same parameter set. Config keys that Constants does
+    not read, e.g. misspelled parameters, do not change the result and are left out.
+
+    Parameters
+    ----------
+    constant : Constants
+        Model parameters.
+
+    Returns
+    -------
+    dict
+        Parameter name -> normalized value, plus the velocity components.
+    """
+    parameters = {
+        key: _normalize(getattr(constant, key.upper()))
+        for key in constant.config["PARAMETERS"]
+        if key not in NON_PHYSICAL_PARAMETERS and hasattr(constant, key.upper())
+    }
+    parameters["components"] = [
+        {name: _normalize(value) for name, value in vars(component).items()} for component in constant.COMPONENTS
+    ]
+    return parameters
+
+
+def result_key(constant):
+    """Hash of the parameter set, line-list version and code version identifying a model result."""
+    content = {"parameters": parameter_set(constant), "lines": line_list_version(), "code": code_version()}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def line_list_version():
+    """Hash of the line-list data files shipped with the package."""
+    digest = hashlib.sha256()
+    for filename in ("h2fluor_data_Abgrall+1993.npz", "hi_data_NIST.npz"):
+        digest.update(importlib.resources.files("h2ssscam.data").joinpath(filename).read_bytes())
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def code_version():
+    """Hash of the package source code, so that editable installs invalidate results when the code changes."""
+    digest = hashlib.sha256()
+    package = importlib.resources.files("h2ssscam")
+    for name in sorted(entry.name for entry in package.iterdir() if entry.name.endswith(".py")):
+        digest.update(name.encode())
+        digest.update(package.joinpath(name).read_bytes())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Directory of model results keyed by result_key, with least-recently-used eviction.
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding the results; created if missing.
+    max_bytes : int, optional
+        Size limit of the stored results, by default unlimited.
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, constant):
+        """Return the stored result for constant, or None if it was never computed.
+
+        Parameters
+        ----------
+        constant : Constants
+            Model parameters.
+
+        Returns
+        -------
+        dict or None
+            Result in the layout of run_model.
+        """
+        key = result_key(constant)
+        path = self._path(key, ".npz")
+        try:
+            with open(self._path(key, ".json")) as file:
+                meta = json.load(file)
+            units = u.Unit(meta["units"])
+            plain = meta.get("plain_arrays", [])
+            array_units = {name: u.Unit(unit) for name, unit in meta.get("array_units", {}).items()}
+            with np.load(path) as data:
+                result = {
+                    name: data[name] if name in plain else data[name] * array_units.get(name, _unit(name, units))
+                    for name in data.files
+                }
+            self._touch(path)
+        except FileNotFoundError:  # never stored, or evicted by another process meanwhile
+            return None
+        result["units"] = units
+        result["line_selection"] = meta["line_selection"]
+        return result
+
+    def put(self, constant, result):
+        """Store a result of run_model for constant and evict old results beyond the size limit.
+
+        Parameters
+        ----------
+        constant : Constants
+            Model parameters.
+        result : dict
+            Output of run_model.
+
+        Returns
+        -------
+        str
+            Key of the stored result.
+        """
+        key = result_key(constant)
+        units = result["units"]
+        quantities = {name: value for name, value in result.items() if isinstance(value, u.Quantity)}
+        # arrays in units of their own, e.g. photon rates of a result in energy units
+        array_units = {
+            name: value.unit for name, value in quantities.items() if not value.unit.is_equivalent(_unit(name, units))
+        }
+        arrays = {name: value.to_value(array_units.get(name, _unit(name, units))) for name, value in quantities.items()}
+        # arrays without units, e.g. group labels
+        plain = {name: value for name, value in result.items() if type(value) is np.ndarray}
+        meta = {
+            "parameters": parameter_set(constant),
+            "units": units.to_string(),
+            "plain_arrays": sorted(plain),
+            "array_units": {name: unit.to_string() for name, unit in array_units.items()},
+            "line_selection": result["line_selection"],
+            "created": time.time(),
+        }
+        # write the metadata first: a result is only listed by entries once its npz file exists
+        self._write(key, ".json", lambda file: file.write(json.dumps(meta).encode()))
+        self._write(key, ".npz", lambda file: np.savez(file, **arrays, **plain))
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+        return key
+
+    def entries(self):
+        """List the stored results, least recently used first.
+
+        Returns
+        -------
+        list of dict
+            key, size (bytes), last_used (epoch seconds) and parameters of every result.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz") or name.endswith(".tmp.npz"):
+                continue
+            key = name[: -len(".npz")]
+            try:
+                stat = os.stat(self._path(key, ".npz"))
+                with open(self._path(key, ".json")) as file:
+                    parameters = json.load(file)["parameters"]
+                size = stat.st_size + os.path.getsize(self._path(key, ".json"))
+            except FileNotFoundError:  # removed by another process since listdir
+                continue
+            entries.append({"key": key, "size": size, "last_used": stat.st_mtime, "parameters": parameters})
+        return sorted(entries, key=lambda entry: entry["last_used"])
+
+    def size(self):
+        """Total size of the stored results in bytes."""
+        return sum(entry["size"] for entry in self.entries())
+
+    def evict(self, max_bytes):
+        """Remove least recently used results until the store is at most max_bytes.
+
+        Returns
+        -------
+        list of str
+            Keys of the removed results.
+        """
+        entries = self.entries()
+        total = sum(entry["size"] for entry in entries)
+        removed = []
+        for entry in entries:
+            if total <= max_bytes:
+                break
+            self.remove(entry["key"])
+            total -= entry["size"]
+            removed.append(entry["key"])
+        return removed
+
+    def remove(self, key):
+        """Remove one stored result."""
+        for suffix in (".npz", ".json"):
+            try:
+                os.remove(self._path(key, suffix))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        """Remove all stored results."""
+        for entry in self.entries():
+            self.remove(entry["key"])
+
+    @staticmethod
+    def _touch(path):
+        """Mark a result as used now; explicit times avoid the coarse timestamps of some file systems."""
+        now = time.time()
+        os.utime(path, (now, now))
+
+    def _write(self, key, suffix, write):
+        """Write a result file through a private temporary file, so concurrent writers and readers never clash."""
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp" + suffix, prefix=key + ".", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                write(file)
+            self._touch(tmp_path)
+            os.replace(tmp_path, self._path(key, suffix))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+
+def _unit(name, units):
+    """Storage unit of the array name of a result in units."""
+    return u.AA if name in WAVELENGTH_ARRAYS else units
+
+
+def _normalize(value):
+    """JSON-serializable, canonical form of a parameter value."""
+    if value is None:
+        return None
+    if isinstance(value, u.Quantity):
+        return [float(value.value), value.unit.to_string()]
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value.strip()
+    return float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and trim an h2ssscam result cache.")
+    parser.add_argument("directory", help="result cache directory (RESULT_CACHE_DIR)")
+    parser.add_argument("--list", action="store_true", help="list the stored results")
+    parser.add_argument("--evict", type=float, metavar="MB", help="evict results beyond this size")
+    parser.add_argument("--clear", action="store_true", help="remove all stored results")
+    args = parser.parse_args()
+
+    cache = ResultCache(args.directory)
+    if args.clear:
+        cache.clear()
+    if args.evict is not None:
+        for key in cache.evict(int(args.evict * 1e6)):
+            print(f"Evicted {key}")
+    if args.list or not (args.clear or args.evict is not None):
+        for entry in cache.entries():
+            last_used = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["last_used"]))
+            print(f"{entry['key'][:16]}  {entry['size'] / 1e6:8.2f} MB  {last_used}  {entry['parameters']}")
+        print(f"Total: {cache.size() / 1e6:.2f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Warm local model server: keeps the line data, wavelength grids, absorption cross-sections and recent results
+resident and returns spectra over HTTP on localhost.
+
+Usage: python -m h2ssscam serve [config file] [--port PORT] [--workers N] [--cache-size N] [--siglu-cache-mb MB]
+       [--warmup]
+
+POST /spectrum with a JSON object of parameter overrides (e.g. {"TH2": 300, "NH2_TOT": 1e19}) returns an
+uncompressed npz file with lam_shifted, spec and spec_tot. Requests that evaluate the same lines at the same Doppler
+width reuse the cross-sections of earlier requests, e.g. requests that change only the HI or source parameters, or,
+unless SPARSE_THRESHOLD truncates the cross-sections by optical depth, the H2 column density. GET /stats returns
+request, latency and cache counters as JSON.
+"""
+import argparse
+import io
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from h2ssscam.BaseCalc import BaseCalc, CrossSectionCache
+from h2ssscam.Constants import Constants
+from h2ssscam.model import load_lines, restrict_lines, run_cached, wavelength_grid
+
+logger = logging.getLogger(__name__)
+
+
+class ModelServer:
+    """Resident model state shared by all requests.
+
+    Parameters
+    ----------
+    user_config_path : str, optional
+        Config file that requests override, by default the package defaults.
+    n_workers : int, optional
+        Maximum number of models computed concurrently, by default 4
+    cache_size : int, optional
+        Number of recent results kept in memory, by default 32
+    siglu_cache_mb : float, optional
+        Size limit of the absorption cross-sections kept in memory, by default 1000
+    """
+
+    def __init__(self, user_config_path=None, n_workers=4, cache_size=32, siglu_cache_mb=1000):
+        self.user_config_path = user_config_path
+        self.constant = Constants(user_config_path)
+        self.lines = load_lines(self.constant)
+        self.cache_size = cache_size
+        self.siglu_cache = CrossSectionCache(int(siglu_cache_mb * 1e6))
+        self._executor = ThreadPoolExecutor(max_workers=n_workers)
+        self._results = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "errors": 0,
+            "cache_hits": 0,
+            "cache_misses": 0,
+            "inflight_joins": 0,
+            "total_latency_ms": 0.0,
+            "max_latency_ms": 0.0,
+        }
+
+    def spectrum(self, overrides):
+        """Return the npz-encoded spectrum for a set of parameter overrides.
+
+        Parameters
+        ----------
+        overrides : dict
+            Parameter values by config name.
+
+        Returns
+        -------
+        bytes
+            npz file with lam_shifted, spec and spec_tot.
+        bool
+            Whether the result came from the cache. Requests that arrive while the same result is being computed
+            wait for that computation instead of starting their own, and count as misses.
+
+        Raises
+        ------
+        ValueError
+            If the overrides ask for more H2 levels than the resident line data holds.
+        """
+        key = tuple(sorted((name.lower(), str(value)) for name, value in overrides.items()))
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.counters["cache_hits"] += 1
+                return self._results[key], True
+            self.counters["cache_misses"] += 1
+            future = self._pending.get(key)
+            if future is not None:
+                self.counters["inflight_joins"] += 1
+                owner = False
+            else:
+                future = self._pending[key] = self._executor.submit(self._compute, overrides)
+                owner = True
+
+        try:
+            payload = future.result()
+        finally:
+            if owner:
+                with self._lock:
+                    del self._pending[key]
+                    if future.exception() is None:
+                        self._results[key] = future.result()
+                        while len(self._results) > self.cache_size:
+                            self._results.popitem(last=False)
+        return payload, False
+
+    def _compute(self, overrides):
+        """Run the model for one request and encode the result."""
+        constant = Constants(self.user_config_path, overrides)
+        if constant.VMAX > self.constant.VMAX or constant.JMAX > self.constant.JMAX:
+            raise ValueError("VMAX and JMAX cannot exceed those of the server config")
+        basecalc = BaseCalc(constant, siglu_cache=self.siglu_cache)
+        result = run_cached(constant, restrict_lines(self.lines, constant), basecalc)
+        buffer = io.BytesIO()
+        units = result["units"]
+        np.savez(
+            buffer,
+            lam_shifted=result["lam_shifted"].value,
+            spec=result["spec"].to(units).value,
+            spec_tot=result["spec_tot"].to(units).value,
+        )
+        return buffer.getvalue()
+
+    def record(self, latency_ms, error=False):
+        """Add one request to the counters."""
+        with self._lock:
+            self.counters["requests"] += 1
+            self.counters["errors"] += int(error)
+            self.counters["total_latency_ms"] += latency_ms
+            self.counters["max_latency_ms"] = max(self.counters["max_latency_ms"], latency_ms)
+
+    def stats(self):
+        """Request, latency and cache counters."""
+        with self._lock:
+            stats = dict(self.counters)
+        stats["mean_latency_ms"] = stats["total_latency_ms"] / stats["requests"] if stats["requests"] else 0.0
+        stats["cached_results"] = len(self._results)
+        grid_cache = wavelength_grid.cache_info()
+        stats["grid_cache_hits"], stats["grid_cache_misses"] = grid_cache.hits, grid_cache.misses
+        stats["siglu_cache_hits"], stats["siglu_cache_misses"] = self.siglu_cache.hits, self.siglu_cache.misses
+        stats["siglu_cache_mb"] = self.siglu_cache.nbytes / 1e6
+        return stats
+
+    def serve(self, host="127.0.0.1", port=8765):
+        """Serve requests until interrupted.
+
+        Parameters
+        ----------
+        host : str, optional
+            Address to bind, by default localhost only
+        port : int, optional
+            Port to bind, by default 8765
+        """
+        httpd = self.make_http_server(host, port)
+        logger.info(f"Serving h2ssscam models on http://{host}:{httpd.server_address[1]}")
+        try:
+            httpd.serve_forever()
+        finally:
+            httpd.server_close()
+            self._executor.shutdown()
+
+    def make_http_server(self, host="127.0.0.1", port=8765):
+        """Build the HTTP server without starting it (port 0 picks a free port)."""
+        httpd = ThreadingHTTPServer((host, port), _RequestHandler)
+        httpd.model_server = self
+        return httpd
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """HTTP front end of a ModelServer."""
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/stats":
+            self.send_error(404)
+            return
+        self._send(200, "application/json", json.dumps(self.server.model_server.stats()).encode())
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/spectrum":
+            self.send_error(404)
+            return
+        model_server = self.server.model_server
+        start = time.perf_counter()
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            overrides = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(overrides, dict):
+                raise ValueError("Request body must be a JSON object of parameter overrides")
+            payload, hit = model_server.spectrum(overrides)
+        except ValueError as error:
+            model_server.record(1e3 * (time.perf_counter() - start), error=True)
+            self._send(400, "text/plain", str(error).encode())
+            return
+        except Exception as error:
+            logger.exception("Model request failed")
+            model_server.record(1e3 * (time.perf_counter() - start), error=True)
+            self._send(500, "text/plain", f"{type(error).__name__}: {error}".encode())
+            return
+        latency_ms = 1e3 * (time.perf_counter() - start)
+        model_server.record(latency_ms)
+        headers = {"X-Latency-Ms": f"{latency_ms:.1f}", "X-Cache": "HIT" if hit else "MISS"}
+        self._send(200, "application/octet-stream", payload, headers)
+
+    def _send(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} {format % args}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="h2ssscam serve", description="Serve h2ssscam spectra on localhost.")
+    parser.add_argument("config", nargs="?", default=None, help="config file that requests override")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on")
+    parser.add_argument("--workers", type=int, default=4, help="maximum number of concurrent model runs")
+    parser.add_argument("--cache-size", type=int, default=32, help="number of recent results kept in memory")
+    parser.add_argument("--siglu-cache-mb", type=float, default=1000, help="memory for resident cross-sections")
+    parser.add_argument("--warmup", action="store_true", help="compute the unmodified config before serving")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    model_server = ModelServer(args.config, args.workers, args.cache_size, args.siglu_cache_mb)
+    if args.warmup:
+        model_server.spectrum({})
+    model_server.serve(port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+"""
+Contains the fixtures shared by the model tests.
+"""
+import pytest
+from h2ssscam.Constants import Constants
+from h2ssscam.model import load_lines
+
+
+@pytest.fixture(scope="session")
+def lines():
+    """Return the line lists shared by the model tests."""
+    return load_lines(Constants())
+
+
+@pytest.fixture
+def make_constant(tmp_path):
+    """Return a function building Constants for a coarse-grid config in tmp_path with optional extra config text."""
+
+    def make(extra=""):
+        config_path = tmp_path / "config.ini"
+        config_path.write_text("[PARAMETERS]\nDLAM = 0.05\nBP_MIN = 1550\nBP_MAX = 1620\n" + extra)
+        return Constants(str(config_path))
+
+    return make
@@ -3,10 +3,12 @@ Contains the tests for the BaseCalc module.
 """
 import numpy as np
 import pytest
+import astropy.constants as c
 import astropy.units as u
 from astropy.units import Quantity
 from astropy.units.core import UnitConversionError
 from h2ssscam.BaseCalc import BaseCalc
+from h2ssscam.Constants import Constants
 
 class TestBaseCalc:
     """
@@ -22,7 +24,7 @@ class TestBaseCalc:
         BaseCalc
             A new BaseCalc instance.
         """
-        return BaseCalc()
+        return BaseCalc(Constants())
 
     @staticmethod
     @pytest.mark.parametrize("lam,dopp_v,expected_dopp_shift", [
@@ -48,3 +50,235 @@ class TestBaseCalc:
                 assert np.isinf(actual_dopp_shift.value) and np.isinf(expected_dopp_shift.value)
             else:
                 assert actual_dopp_shift == expected_dopp_shift
+
+    @staticmethod
+    def test_calc_dlam(base_calc):
+        """
+        Tests that BaseCalc.calc_dlam samples the Doppler FWHM with the requested number of points.
+        """
+        dv = 10 * u.km / u.s
+        dlam = base_calc.calc_dlam(dv, 1500 * u.AA, 5)
+        fwhm = 2 * np.sqrt(np.log(2)) * 1500 * 10 / 299792.458
+        assert dlam.unit == u.AA
+        assert dlam.value == pytest.approx(fwhm / 5)
+
+        # the half-maximum points of the Doppler core sit half a FWHM from line center
+        voigt = base_calc._voigt(1500 * u.AA + np.array([0, 2.5]) * dlam, 1500 * u.AA, 0 / u.s, dv)
+        assert float(voigt[1] / voigt[0]) == pytest.approx(0.5)
+
+    @staticmethod
+    def test_sparse_siglu(base_calc):
+        """
+        Tests that sparse cross-sections and optical depths match the dense ones above the truncation threshold.
+        """
+        lam = np.linspace(1000, 1100, 20000) * u.AA
+        lamlu = [1020, 1050, 1080] * u.AA
+        Atot = [1e9, 1e8, 1e7] / u.s
+        flu = np.array([0.01, 0.02, 0.005])
+        nvj = [1e20, 1e15, 1e12] * u.cm**-2
+        dv = 10 * u.km / u.s
+
+        dense = base_calc._calc_siglu(lam, lamlu, Atot, dv, flu)
+        sparse_siglu = base_calc._calc_siglu(lam, lamlu, Atot, dv, flu, threshold=1e-6, nvj=nvj)
+        assert sparse_siglu.nnz < dense.size / 2
+
+        tau_dense = base_calc._calc_tau(nvj, dense)
+        tau_sparse = base_calc._calc_tau(nvj, sparse_siglu).toarray()
+        np.testing.assert_allclose(tau_sparse[tau_sparse > 0], tau_dense.value[tau_sparse > 0])
+        assert np.all(tau_dense.value[tau_sparse == 0] < 1e-6)
+
+    @staticmethod
+    @pytest.mark.parametrize("threshold", [None, 1e-6])
+    def test_parallel_lines(base_calc, threshold):
+        """
+        Tests that tiling the per-line work over a thread pool reproduces the serial result bit for bit.
+        """
+        lam = np.linspace(1400, 1600, 5000) * u.AA
+        lamlu = np.linspace(1410, 1590, 11) * u.AA
+        Atot = np.full(11, 1e9) / u.s
+        flu = np.full(11, 0.01)
+        dv = 10 * u.km / u.s
+
+        serial = base_calc._calc_siglu(lam, lamlu, Atot, dv, flu, threshold), base_calc.calc_profiles(
+            lam, lamlu, Atot, dv, threshold
+        )
+        base_calc.constant.N_WORKERS = 3
+        parallel = base_calc._calc_siglu(lam, lamlu, Atot, dv, flu, threshold), base_calc.calc_profiles(
+            lam, lamlu, Atot, dv, threshold
+        )
+        for expected, actual in zip(serial, parallel):
+            if threshold:
+                expected, actual = expected.toarray(), actual.toarray()
+            assert np.array_equal(expected, actual)
+
+    @staticmethod
+    def test_tiled_spec(base_calc, tmp_path):
+        """
+        Tests that tiled synthesis into a memory-mapped array matches the spectrum built on the whole grid.
+        """
+        unit = base_calc.constant.CU_UNIT
+        lam = np.linspace(1400, 1600, 20000) * u.AA
+        lamlu = [1420, 1500, 1580] * u.AA
+        Atot = [1e9, 1e8, 1e7] / u.s
+        flux = [1.0, 2.0, 0.5] * unit
+        dv = 13 * u.km / u.s
+        source = np.zeros(len(lam)) * unit
+
+        _, spec, _ = base_calc.calc_spec(lam, lamlu, Atot, dv, flux, source, unit)
+        out = np.lib.format.open_memmap(tmp_path / "spec.npy", mode="w+", shape=(len(lam),))
+        _, spec_tiled, _ = base_calc.calc_spec(lam, lamlu, Atot, dv, flux, source, unit, tile_size=3000, out=out)
+
+        np.testing.assert_allclose(spec_tiled.value, spec.value, rtol=0, atol=1e-6 * spec.value.max())
+        np.testing.assert_array_equal(np.load(tmp_path / "spec.npy"), spec_tiled.value)
+
+    @staticmethod
+    def test_tiled_spec_pool(base_calc, monkeypatch):
+        """
+        Tests that parallel tiled synthesis starts one worker pool for all tiles and matches the serial spectrum.
+        """
+        import h2ssscam.BaseCalc as basecalc_module
+
+        pools = []
+
+        class CountingPool(basecalc_module.ThreadPoolExecutor):
+            def __init__(self, *args, **kwargs):
+                pools.append(self)
+                super().__init__(*args, **kwargs)
+
+        unit = base_calc.constant.CU_UNIT
+        lam = np.linspace(1400, 1600, 20000) * u.AA
+        lamlu = np.linspace(1410, 1590, 11) * u.AA
+        Atot = np.full(11, 1e9) / u.s
+        flux = np.ones(11) * unit
+        dv = 13 * u.km / u.s
+        source = np.zeros(len(lam)) * unit
+
+        _, serial, _ = base_calc.calc_spec(lam, lamlu, Atot, dv, flux, source, unit, tile_size=3000)
+        monkeypatch.setattr(basecalc_module, "ThreadPoolExecutor", CountingPool)
+        base_calc.constant.N_WORKERS = 3
+        _, parallel, _ = base_calc.calc_spec(lam, lamlu, Atot, dv, flux, source, unit, tile_size=3000)
+
+        assert len(pools) == 1 and base_calc._executor is None
+        np.testing.assert_array_equal(parallel.value, serial.value)
+
+    @staticmethod
+    def test_resample_spectra(base_calc):
+        """
+        Tests that batch Doppler resampling conserves flux on fine and coarse output grids, moves lines by v/c,
+        leaves unshifted spectra unchanged and matches resampling each spectrum on its own.
+        """
+        lam = np.linspace(1500, 1600, 100001) * u.AA
+        spectra = np.stack([np.exp(-(((lam.value - lam0) / 0.02) ** 2)) for lam0 in (1530, 1550, 1570)])
+        dopp_v = [0, 30, -45] * u.km / u.s
+        factor = 1 + (dopp_v / c.c).decompose().value
+
+        out = base_calc.resample_spectra(lam, spectra * u.erg, dopp_v, lam)
+        assert out.shape == spectra.shape and out.unit == u.erg
+        np.testing.assert_allclose(out[0].value, spectra[0], rtol=0, atol=1e-12)
+        np.testing.assert_allclose(out.value.sum(axis=1), spectra.sum(axis=1) * factor, rtol=1e-12)
+        peaks = lam.value[np.argmax(out.value, axis=1)]
+        np.testing.assert_allclose(peaks, [1530, 1550, 1570] * factor, atol=1e-3)
+
+        coarse = np.linspace(1500, 1600, 2001) * u.AA
+        out_coarse = base_calc.resample_spectra(lam, spectra, dopp_v, coarse)
+        np.testing.assert_allclose(out_coarse.sum(axis=1) * 0.05, spectra.sum(axis=1) * 0.001 * factor, rtol=1e-10)
+        for i in range(3):
+            single = base_calc.resample_spectra(lam, spectra[i : i + 1], dopp_v[i], coarse)
+            np.testing.assert_allclose(single[0], out_coarse[i], rtol=1e-14, atol=1e-300)
+
+        # one spectrum for every velocity, and middle axes resampled together
+        sweep = base_calc.resample_spectra(lam, spectra[None], dopp_v, coarse)
+        assert sweep.shape == (3, 3, len(coarse))
+        np.testing.assert_allclose(sweep[:, 1], base_calc.resample_spectra(lam, spectra[1:2], dopp_v, coarse))
+
+    @staticmethod
+    def test_level_populations(base_calc):
+        """
+        Tests that tabulated H2 populations match the exact Boltzmann populations, that temperatures outside the
+        table fall back to the exact ones and that repeated temperatures are served from the cache.
+        """
+        from h2ssscam.BaseCalc import level_populations
+
+        vmax, jmax = int(base_calc.constant.VMAX), int(base_calc.constant.JMAX)
+        es = base_calc._calc_e(np.arange(vmax + 1), np.arange(jmax + 1))
+        for T in (87.3, 523.0, 4321.0):
+            boltzmann = np.exp(-(es / (T * u.K * c.k_B)).decompose().value)
+            expected = boltzmann / boltzmann.sum()
+            np.testing.assert_allclose(level_populations(vmax, jmax, T, False), expected, rtol=1e-12, atol=1e-250)
+            np.testing.assert_allclose(level_populations(vmax, jmax, T), expected, rtol=1e-10, atol=1e-250)
+        for T in (5.0, 2e5):
+            assert np.array_equal(level_populations(vmax, jmax, T), level_populations(vmax, jmax, T, False))
+
+        nvj = base_calc.calc_nvj(1e20 * u.cm**-2, 317.0 * u.K)
+        assert nvj.shape == (vmax + 1, jmax + 1)
+        assert nvj.sum().to_value(u.cm**-2) == pytest.approx(1e20, rel=1e-14)
+        assert level_populations(vmax, jmax, 317.0, True) is level_populations(vmax, jmax, 317.0, True)
+
+    @staticmethod
+    @pytest.mark.parametrize("threshold,tile_size,precision", [
+        (None, None, "DOUBLE"),
+        (1e-6, None, "DOUBLE"),
+        (1e-6, 3000, "DOUBLE"),
+        (None, None, "SINGLE"),
+    ])
+    def test_grouped_spec(base_calc, threshold, tile_size, precision):
+        """
+        Tests that each group spectrum equals the spectrum of the group's lines alone, for one and two flux rows.
+        """
+        base_calc.constant.PRECISION = precision
+        unit = base_calc.constant.CU_UNIT
+        lam = np.linspace(1400, 1600, 20000) * u.AA
+        lamlu = [1420, 1500, 1580, 1590] * u.AA
+        Atot = [1e9, 1e8, 1e7, 1e8] / u.s
+        flux = np.array([[1.0, 2.0, 0.5, 0.3], [0.2, 0.0, 1.0, 4.0]]) * unit
+        groups = np.array([1, 0, 1, 3])
+        dv = 13 * u.km / u.s
+        source = np.zeros(len(lam)) * unit
+        kwargs = {"threshold": threshold, "tile_size": tile_size}
+
+        _, spec, _ = base_calc.calc_spec(lam, lamlu, Atot, dv, flux, source, unit, **kwargs)
+        _, spec_groups, _ = base_calc.calc_spec(lam, lamlu, Atot, dv, flux, source, unit, groups=groups, **kwargs)
+        _, spec_single, _ = base_calc.calc_spec(lam, lamlu, Atot, dv, flux[1], source, unit, groups=groups, **kwargs)
+        assert spec_groups.shape == (2, 4, len(lam)) and spec_single.shape == (4, len(lam))
+        np.testing.assert_allclose(spec_groups.sum(axis=1).value, spec.value, rtol=1e-12, atol=0)
+        np.testing.assert_array_equal(spec_single.value, spec_groups[1].value)
+        assert not spec_groups[:, 2].value.any()
+        for group in (0, 1, 3):
+            member = groups == group
+            _, expected, _ = base_calc.calc_spec(
+                lam, lamlu[member], Atot[member], dv, flux[:, member], source, unit, **kwargs
+            )
+            np.testing.assert_allclose(spec_groups[:, group].value, expected.value, rtol=1e-12, atol=1e-300)
+
+    @staticmethod
+    @pytest.mark.parametrize("threshold", [None, 1e-6])
+    def test_single_precision(base_calc, threshold):
+        """
+        Tests that single precision stores cross-sections, optical depths and profiles as float32 while the
+        optical-depth and spectrum sums stay float64 and close to the double-precision results.
+        """
+        unit = base_calc.constant.CU_UNIT
+        lam = np.linspace(1400, 1600, 20000) * u.AA
+        lamlu = [1420, 1500, 1580] * u.AA
+        Atot = [1e9, 1e8, 1e7] / u.s
+        flu = np.array([0.01, 0.02, 0.005])
+        nvj = [1e20, 1e15, 1e12] * u.cm**-2
+        flux = [1.0, 2.0, 0.5] * unit
+        dv = 13 * u.km / u.s
+        source = np.zeros(len(lam)) * unit
+
+        results = {}
+        for precision in ("DOUBLE", "SINGLE"):
+            base_calc.constant.PRECISION = precision
+            base_calc._siglu = base_calc._calc_siglu(lam, lamlu, Atot, dv, flu, threshold, nvj)
+            base_calc._tau = base_calc._calc_tau(nvj, base_calc._siglu)
+            tau_tot = base_calc._calc_tau_tot()
+            _, spec, _ = base_calc.calc_spec(lam, lamlu, Atot, dv, flux, source, unit, threshold=threshold)
+            results[precision] = base_calc._siglu.dtype, base_calc._tau.dtype, tau_tot, spec
+
+        siglu_dtype, tau_dtype, tau_tot, spec = results["SINGLE"]
+        assert siglu_dtype == np.float32 and tau_dtype == np.float32
+        assert tau_tot.dtype == np.float64 and spec.dtype == np.float64
+        _, _, tau_tot_ref, spec_ref = results["DOUBLE"]
+        np.testing.assert_allclose(tau_tot.value, tau_tot_ref.value, rtol=1e-6)
+        np.testing.assert_allclose(spec.value, spec_ref.value, rtol=0, atol=1e-6 * spec_ref.value.max())
@@ -0,0 +1,22 @@
+"""
+Contains the tests for the batch module.
+"""
+import numpy as np
+from h2ssscam.batch import run_batch
+from h2ssscam.Constants import Constants
+from h2ssscam.model import run_model
+
+
+def test_run_batch(tmp_path, lines, make_constant):
+    """
+    Tests that models run by the shared-memory batch runner match models run directly.
+    """
+    make_constant()
+    config_path = str(tmp_path / "config.ini")
+    paths = run_batch([{"TH2": 300}, {"TH2": 500}], config_path, n_workers=2, output_dir=str(tmp_path))
+
+    assert len(set(paths)) == 2
+    expected = run_model(Constants(config_path, {"TH2": 300}), lines)
+    with np.load(paths[0]) as saved:
+        np.testing.assert_array_equal(saved["spec"], expected["spec"].value)
+        np.testing.assert_array_equal(saved["lam_shifted"], expected["lam_shifted"].value)
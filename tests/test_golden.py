@@ -0,0 +1,22 @@
+"""
+Contains the tests for the golden module.
+"""
+from h2ssscam.golden import DEFAULT_TOLERANCES, compare, generate
+
+
+def test_golden(tmp_path, make_constant):
+    """
+    Tests that the golden-spectrum harness reproduces its own references exactly and flags a truncated engine.
+    """
+    make_constant()
+    config_path = str(tmp_path / "config.ini")
+    index = generate(str(tmp_path / "golden"), config_path, {"coarse": {"TH2": 300}})
+    assert list(index) == ["coarse"] and index["coarse"]["time_s"] > 0
+
+    (exact,) = compare(str(tmp_path / "golden"), {})
+    assert exact["passed"] and set(exact["errors"]) == set(DEFAULT_TOLERANCES)
+    assert all(error == 0 for error in exact["errors"].values())
+
+    (truncated,) = compare(str(tmp_path / "golden"), {"SPARSE_THRESHOLD": 1e-3}, tolerances={"spec": 1e-12})
+    assert not truncated["passed"] and "spec" in truncated["failed"]
+    assert 0 < truncated["errors"]["spec"] < 0.1 and truncated["errors"]["siglu"] > 0
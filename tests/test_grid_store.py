@@ -0,0 +1,34 @@
+"""
+Contains the tests for the grid_store module.
+"""
+import numpy as np
+from h2ssscam.batch import run_batch
+from h2ssscam.Constants import Constants
+from h2ssscam.grid_store import GridStore
+from h2ssscam.model import run_model
+
+
+def test_grid_store(tmp_path, lines, make_constant):
+    """
+    Tests that batch results appended to a compressed grid store can be found, read and streamed back.
+    """
+    make_constant()
+    config_path = str(tmp_path / "config.ini")
+    overrides = [{"TH2": 300}, {"TH2": 500}, {"TH2": 300, "NH2_TOT": 1e19}]
+    with GridStore(str(tmp_path / "store"), shard_size=2, compression="ZLIB") as store:
+        assert run_batch(overrides, config_path, n_workers=2, store=store) == [0, 1, 2]
+    assert sorted(path.name for path in (tmp_path / "store").glob("spec_0*")) == ["spec_00000.npy.z", "spec_00001.npy"]
+
+    store = GridStore(str(tmp_path / "store"))
+    assert len(store) == 3
+    assert store.find(th2=300) == [0, 2]
+    assert store.find(th2=300, nh2_tot=1e19) == [2]
+    expected = run_model(Constants(config_path, {"TH2": 500}), lines)
+    assert store.find(Constants(config_path, {"TH2": 500})) == [1]
+    np.testing.assert_array_equal(store.read(1)["spec"].value, expected["spec"].value)
+    np.testing.assert_array_equal(store.lam.value, expected["lam_shifted"].value)
+
+    streamed = [(entry["model"], spectra["spec_tot"]) for entry, spectra in store.iter_models(fields=("spec_tot",))]
+    assert [model for model, _ in streamed] == [0, 1, 2]
+    np.testing.assert_array_equal(streamed[1][1].value, expected["spec_tot"].value)
+    assert [entry["model"] for entry, _ in store.iter_models(("spec",), shard=1)] == [2]
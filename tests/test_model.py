@@ -0,0 +1,171 @@
+"""
+Contains the tests for the model module.
+"""
+import astropy.units as u
+import numpy as np
+import pytest
+from h2ssscam.model import run_model
+
+
+def test_single_component_default(lines, make_constant):
+    """
+    Tests that a config without component sections yields one component from the H2 gas parameters.
+    """
+    constant = make_constant()
+    assert len(constant.COMPONENTS) == 1
+    assert constant.COMPONENTS[0].NH2_TOT == constant.NH2_TOT
+
+    result = run_model(constant, lines)
+    assert result["spec_components"].shape == (1, len(result["lam_shifted"]))
+    np.testing.assert_allclose(result["spec_components"][0].value, result["spec"].value)
+
+
+def test_dense_memory_warning(lines, make_constant, monkeypatch, caplog):
+    """
+    Tests that the projected size of the dense absorption matrices is logged, with a warning when it is large.
+    """
+    import h2ssscam.model
+
+    monkeypatch.setattr(h2ssscam.model, "DENSE_MEMORY_WARNING", 1e6)
+    with caplog.at_level("INFO", logger="h2ssscam.model"):
+        run_model(make_constant(), lines)
+    assert any("Dense absorption matrices:" in record.message for record in caplog.records)
+    assert any(record.levelname == "WARNING" and "SPARSE_THRESHOLD" in record.message for record in caplog.records)
+
+
+def test_multi_component(lines, make_constant):
+    """
+    Tests that component spectra sum to the total and that a shifted component moves its emission.
+    """
+    constant = make_constant(
+        "[COMPONENT_1]\nNH2_TOT = 5e19\n[COMPONENT_2]\nNH2_TOT = 5e19\nDOPPLER_SHIFT = 30\n",
+    )
+    assert [comp.DOPPLER_SHIFT.to_value(u.km / u.s) for comp in constant.COMPONENTS] == [0, 30]
+
+    result = run_model(constant, lines)
+    spec_components = result["spec_components"].value
+    np.testing.assert_allclose(spec_components.sum(axis=0), result["spec"].value)
+
+    # identical gas at +30 km/s: the strongest line peaks ~0.16 Å redward at 1600 Å
+    lam = result["lam_shifted"].value
+    peak = np.argmax(spec_components[0])
+    window = slice(peak - 20, peak + 20)
+    shift = lam[window][np.argmax(spec_components[1][window])] - lam[peak]
+    assert shift == pytest.approx(lam[peak] * 30 / 299792.458, abs=0.05)
+
+
+def test_auto_line_selection(lines, make_constant):
+    """
+    Tests that automatic line selection stays within its flux tolerance of the unpruned emission and keeps the
+    absorption imprinted on the continuum.
+    """
+    reference = run_model(make_constant("LINE_SELECTION = AUTO\nFLUX_TOLERANCE = 1e-4\n"), lines)
+    result = run_model(make_constant("LINE_SELECTION = AUTO\nFLUX_TOLERANCE = 1e-2\n"), lines)
+
+    selection = result["line_selection"][0]
+    assert selection["flux_discarded"] <= 1e-2
+    assert selection["pumping_lines"] < reference["line_selection"][0]["pumping_lines"]
+    assert (result["spec"].sum() / reference["spec"].sum()).value == pytest.approx(1, abs=1e-2)
+    source, source_ref = result["source"].value, reference["source"].value
+    np.testing.assert_allclose(source, source_ref, rtol=2e-2, atol=1e-6 * source_ref.max())
+
+
+def test_dissociation(tmp_path, lines, make_constant):
+    """
+    Tests that dissociation rates follow from the absorption rates and are saved and cached with the spectrum.
+    """
+    from h2ssscam.model import DISSOCIATION_UNIT, dissociation_rates, run_cached, save_result
+
+    cache_dir = tmp_path / "cache"
+    constant = make_constant(f"DISSOCIATION = ON\nRESULT_CACHE_DIR = {cache_dir}\n")
+    result = run_cached(constant, lines)
+    h2 = lines["h2"]
+
+    # in CU the absorption rates are already photon counts integrated over wavelength
+    per_trans, per_level = dissociation_rates(constant, h2, result["abs_rate_per_trans"])
+    absorbed = result["abs_rate_per_trans"].value
+    p_diss = (h2["Auldiss"] / h2["Atot"]).decompose().value
+    assert per_level.shape == (1, int(constant.VMAX) + 1, int(constant.JMAX) + 1)
+    assert per_level.unit == DISSOCIATION_UNIT
+    np.testing.assert_allclose(per_level.sum().value, np.sum(absorbed * p_diss))
+    np.testing.assert_allclose(result["dissociation_rate"].value, per_level.sum(axis=(1, 2)).value)
+    assert 0 < result["dissociation_rate"][0].value < absorbed.sum()
+
+    # the rates do not depend on the sampling of the source grid
+    fine = run_model(make_constant("DISSOCIATION = ON\nSOURCE_DLAM = 0.05\n"), lines)
+    assert fine["dissociation_rate"][0].value == pytest.approx(result["dissociation_rate"][0].value, rel=0.03)
+
+    with np.load(save_result(constant, result, str(tmp_path))) as saved:
+        np.testing.assert_array_equal(saved["dissociation_per_level"], result["dissociation_per_level"].value)
+    cached = run_cached(constant, lines)
+    np.testing.assert_array_equal(cached["dissociation_rate"].value, result["dissociation_rate"].value)
+
+    # absorption-only lines of AUTO selection still feed the dissociation rate
+    auto = run_model(make_constant("LINE_SELECTION = AUTO\nDISSOCIATION = ON\n"), lines)
+    assert auto["dissociation_rate"][0].value == pytest.approx(result["dissociation_rate"][0].value, rel=0.01)
+
+    # photon counts do not depend on the unit of the spectrum
+    ergs_constant = make_constant(f"DISSOCIATION = ON\nUNIT = ERGS\nRESULT_CACHE_DIR = {cache_dir}\n")
+    ergs = run_cached(ergs_constant, lines)
+    assert run_cached(ergs_constant, lines)["dissociation_rate"].unit == DISSOCIATION_UNIT
+    np.testing.assert_allclose(ergs["dissociation_per_level"].value, result["dissociation_per_level"].value, rtol=1e-3)
+
+
+@pytest.mark.parametrize("grouping,extra", [("BAND", ""), ("VU", "TILE_SIZE = 2000\n"), ("PUMP", "")])
+def test_spec_groups(tmp_path, lines, grouping, extra, make_constant):
+    """
+    Tests that group spectra of two shifted components sum to the emission spectrum and are saved with it.
+    """
+    from h2ssscam.model import save_result
+
+    components = "[COMPONENT_1]\nNH2_TOT = 5e19\n[COMPONENT_2]\nNH2_TOT = 5e19\nDOPPLER_SHIFT = 30\n"
+    constant = make_constant(f"SPEC_GROUPS = {grouping}\n{extra}{components}")
+    result = run_model(constant, lines)
+    spec_groups, keys = result["spec_groups"].value, result["spec_group_keys"]
+    assert spec_groups.shape == (len(keys), len(result["lam_shifted"]))
+    assert len(keys) > 1 and np.all(spec_groups.sum(axis=1) > 0)
+    np.testing.assert_allclose(spec_groups.sum(axis=0), result["spec"].value, rtol=1e-10, atol=0)
+    if grouping == "BAND":
+        assert "Ly" in keys and "Wp" in keys
+
+    with np.load(save_result(constant, result, str(tmp_path))) as saved:
+        np.testing.assert_array_equal(saved["spec_group_keys"], keys)
+        np.testing.assert_array_equal(saved["spec_groups"], spec_groups)
+
+
+def test_spec_groups_without_emission(lines, make_constant):
+    """
+    Tests grouping when one Doppler width has no emission lines and the band labels are bytes, as in SharedLines.
+    """
+    components = "[COMPONENT_1]\nNH2_TOT = 5e19\n[COMPONENT_2]\nNH2_TOT = 1e14\nTH2 = 1000\n"
+    shared = {"h2": {**lines["h2"], "band": lines["h2"]["band"].astype(np.bytes_)}, "hi": lines["hi"]}
+    for grouping in ("BAND", "PUMP"):
+        result = run_model(make_constant(f"SPEC_GROUPS = {grouping}\n{components}"), shared)
+        assert not np.any(result["spec_components"][1].value)
+        np.testing.assert_allclose(result["spec_groups"].value.sum(axis=0), result["spec"].value, rtol=1e-10, atol=0)
+        if grouping == "BAND":
+            assert result["spec_group_keys"].dtype.kind == "U" and "Ly" in result["spec_group_keys"]
+
+
+def test_velocity_sweep(lines, make_constant):
+    """
+    Tests that shifting one synthesis reproduces the spectra of runs at other Doppler shifts on a common grid.
+    """
+    from h2ssscam.BaseCalc import BaseCalc
+    from h2ssscam.model import velocity_sweep
+
+    component = "[COMPONENT_{}]\nNH2_TOT = 5e19\nDOPPLER_SHIFT = {}\n"
+    components = component.format(1, "{}") + component.format(2, "{}")
+    constant = make_constant(components.format(0, 30))
+    result = run_model(constant, lines)
+    lam_out = np.linspace(1560, 1610, 20001) * u.AA
+    lam, sweep = velocity_sweep(constant, result, [-20, 45] * u.km / u.s, lam_out)
+    assert sweep["spec"].shape == sweep["spec_tot"].shape == (2, len(lam_out))
+
+    for spectrum, v in zip(sweep["spec"], (-20, 45)):
+        shifted_constant = make_constant(components.format(v, v + 30))
+        shifted = run_model(shifted_constant, lines)
+        expected = BaseCalc(shifted_constant).resample_spectra(
+            shifted["lam_shifted"], shifted["spec"][None], 0 * u.km / u.s, lam
+        )[0]
+        np.testing.assert_allclose(spectrum.value, expected.value, rtol=0, atol=1e-9 * expected.value.max())
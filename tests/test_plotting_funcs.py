@@ -0,0 +1,52 @@
+"""
+Contains the tests for the plotting_funcs module.
+"""
+import os
+import numpy as np
+from h2ssscam.grid_store import GridStore
+from h2ssscam.plotting_funcs import decimate_minmax, export_pngs
+
+
+def test_decimate_minmax():
+    """
+    Tests that the min/max envelope keeps every bin's extremes, in wavelength order, within the plotted range.
+    """
+    wavelengths = np.linspace(1400, 1700, 300001)
+    intensity = np.random.default_rng(1).normal(size=len(wavelengths))
+    intensity[123457] = 50  # a one-pixel line peak
+
+    lam, spec = decimate_minmax(wavelengths, intensity, 1000)
+    assert len(lam) == 2000 and np.all(np.diff(lam) >= 0)
+    assert spec.max() == 50 and spec.min() == intensity.min()
+
+    lam, spec = decimate_minmax(wavelengths, intensity, 1000, xmin=1500, xmax=1510)
+    assert len(lam) == 2000 and 1500 - 0.001 <= lam[0] < lam[-1] <= 1510 + 0.001
+    np.testing.assert_array_equal(decimate_minmax(wavelengths[:100], intensity[:100], 1000)[1], intensity[:100])
+
+
+def test_export_pngs(tmp_path):
+    """
+    Tests that saved npz models and the models of every grid store shard are rendered to PNG files.
+    """
+    import astropy.units as u
+    from h2ssscam.Constants import Constants
+
+    lam = np.linspace(1400, 1700, 100000)
+    spec = np.exp(-(((lam - 1608) / 0.01) ** 2))
+    np.savez(tmp_path / "model.npz", lam_shifted=lam, spec=spec, spec_tot=spec + 1)
+    unit = Constants().CU_UNIT
+    with GridStore(str(tmp_path / "grid"), shard_size=2, compression="ZLIB") as store:
+        for scale in (1, 2, 3):
+            result = {"lam_shifted": lam * u.AA, "spec": scale * spec * unit, "spec_tot": spec * unit, "units": unit}
+            store.append(Constants(None, {"TH2": 100 * scale}), result)
+
+    pngs = export_pngs([str(tmp_path / "model.npz"), str(tmp_path / "grid")], str(tmp_path / "png"), n_workers=2)
+    assert [os.path.relpath(png, tmp_path / "png") for png in pngs] == [
+        "model.png",
+        os.path.join("grid", "model_00000.png"),
+        os.path.join("grid", "model_00001.png"),
+        os.path.join("grid", "model_00002.png"),
+    ]
+    for png in pngs:
+        with open(png, "rb") as file:
+            assert file.read(8) == b"\x89PNG\r\n\x1a\n"
@@ -0,0 +1,67 @@
+"""
+Contains the tests for the result_cache module.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from h2ssscam.Constants import Constants
+from h2ssscam.model import run_cached
+from h2ssscam.result_cache import ResultCache, result_key
+
+
+def test_result_cache(tmp_path, lines, make_constant):
+    """
+    Tests that identical configs are served from the result cache, changed ones are not, and eviction trims it.
+    """
+    cache_dir = tmp_path / "cache"
+    constant = make_constant(f"RESULT_CACHE_DIR = {cache_dir}\n")
+    first = run_cached(constant, lines)
+    cache = ResultCache(str(cache_dir))
+    assert [entry["key"] for entry in cache.entries()] == [result_key(constant)]
+
+    # same parameters written differently, with a different worker count, hit the stored result
+    same = make_constant(f"RESULT_CACHE_DIR = {cache_dir}\nTH2 = 5.0e2\nN_WORKERS = 2\n")
+    assert result_key(same) == result_key(constant)
+    stored = cache.get(same)
+    assert stored["units"] == first["units"]
+    np.testing.assert_array_equal(stored["spec"].value, first["spec"].value)
+    np.testing.assert_array_equal(stored["lam_shifted"].value, first["lam_shifted"].value)
+
+    other = Constants(str(tmp_path / "config.ini"), {"TH2": 300})
+    assert result_key(other) != result_key(constant)
+    assert cache.get(other) is None
+    run_cached(other, lines)
+    assert len(cache.entries()) == 2
+
+    # the least recently used result goes first
+    cache.get(constant)
+    assert cache.evict(cache.size() - 1) == [result_key(other)]
+    cache.clear()
+    assert cache.entries() == []
+
+
+def test_result_key_unknown_parameter():
+    """
+    Tests that config keys without a model parameter, e.g. typos, do not break or change the result key.
+    """
+    assert result_key(Constants(None, {"DLAM_TYPO": 0.01})) == result_key(Constants())
+
+
+def test_result_cache_concurrent(tmp_path):
+    """
+    Tests that concurrent writers of one result do not clash and that results removed meanwhile are skipped.
+    """
+    constant = Constants()
+    key, units = result_key(constant), constant.CU_UNIT
+    result = {"spec": np.arange(1000.0) * units, "units": units, "line_selection": []}
+    cache = ResultCache(str(tmp_path))
+    with ThreadPoolExecutor(8) as pool:
+        assert set(pool.map(lambda _: cache.put(constant, result), range(16))) == {key}
+    assert sorted(path.name for path in tmp_path.iterdir()) == [key + ".json", key + ".npz"]
+    np.testing.assert_array_equal(cache.get(constant)["spec"].value, result["spec"].value)
+
+    # an eviction by another process between listing or checking a result and opening it
+    (tmp_path / (key + ".json")).unlink()
+    assert cache.entries() == []
+    assert cache.get(constant) is None
+    cache.remove(key)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,92 @@
+"""
+Contains the tests for the server module.
+"""
+import io
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from h2ssscam.Constants import Constants
+from h2ssscam.model import run_model
+from h2ssscam.server import ModelServer
+
+
+def test_model_server(tmp_path, lines, make_constant):
+    """
+    Tests that the model server returns the spectrum of run_model and serves repeated requests from its cache.
+    """
+    make_constant()
+    config_path = str(tmp_path / "config.ini")
+    model_server = ModelServer(config_path, n_workers=2)
+    httpd = model_server.make_http_server(port=0)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    try:
+        responses = []
+        for overrides in ({"TH2": 300}, {"TH2": 300}, {"TH2": 300, "NHI_TOT": 1e19}):
+            request = urllib.request.Request(f"{url}/spectrum", data=json.dumps(overrides).encode())
+            with urllib.request.urlopen(request) as response:
+                responses.append((response.headers["X-Cache"], response.read()))
+        with urllib.request.urlopen(f"{url}/stats") as response:
+            stats = json.load(response)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    assert [hit for hit, _ in responses] == ["MISS", "HIT", "MISS"]
+    assert stats["requests"] == 3 and stats["cache_hits"] == 1
+    expected = run_model(Constants(config_path, {"TH2": 300}), lines)
+    with np.load(io.BytesIO(responses[0][1])) as spectrum:
+        np.testing.assert_array_equal(spectrum["spec"], expected["spec"].value)
+
+    # a changed HI column reuses the resident cross-sections
+    assert stats["siglu_cache_hits"] == stats["siglu_cache_misses"] > 0
+    expected = run_model(Constants(config_path, {"TH2": 300, "NHI_TOT": 1e19}), lines)
+    with np.load(io.BytesIO(responses[2][1])) as spectrum:
+        np.testing.assert_array_equal(spectrum["spec"], expected["spec"].value)
+
+
+def test_model_server_inflight_and_errors(tmp_path, make_constant, monkeypatch):
+    """
+    Tests that concurrent identical requests are computed once and that unexpected failures return status 500.
+    """
+    make_constant()
+    model_server = ModelServer(str(tmp_path / "config.ini"), n_workers=2)
+    calls = []
+    release = threading.Event()
+
+    def compute(overrides):
+        calls.append(overrides)
+        release.wait(60)
+        if overrides["TH2"] == 0:
+            raise RuntimeError("engine failure")
+        return b"spectrum"
+
+    monkeypatch.setattr(model_server, "_compute", compute)
+    with ThreadPoolExecutor(2) as pool:
+        futures = [pool.submit(model_server.spectrum, {"TH2": 300}) for _ in range(2)]
+        deadline = time.monotonic() + 60
+        while model_server.counters["inflight_joins"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        assert [future.result() for future in futures] == [(b"spectrum", False)] * 2
+    assert len(calls) == 1
+    assert model_server.spectrum({"TH2": 300}) == (b"spectrum", True)
+
+    httpd = model_server.make_http_server(port=0)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{httpd.server_address[1]}/spectrum", data=json.dumps({"TH2": 0}).encode()
+        )
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    assert error.value.code == 500
+    assert model_server.stats()["errors"] == 1